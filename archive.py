@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+from io import BytesIO
+from utils import eprint, listdir_files
+
+# ======
+# packed source archive
+# a directory of append-only blob files holding the encoded source images back to back,
+# and an index of (name, blob, offset, size, mtime) for each member
+# members are read by name or position with a single pread, without any per-file open or stat
+
+INDEX = 'index.json'
+VERSION = 1
+EXTS = ['.bmp', '.png', '.jpg', '.jpeg', '.webp', '.jp2', '.tiff']
+
+def blob_name(blob):
+    return '{:05d}.blob'.format(blob)
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path, INDEX))
+
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        self.members = []
+        index_file = os.path.join(path, INDEX)
+        if os.path.exists(index_file):
+            with open(index_file, 'r', encoding='utf-8') as fd:
+                self.members = json.load(fd)['members']
+        self.positions = {member['name']: pos for pos, member in enumerate(self.members)}
+        self._fds = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    @property
+    def names(self):
+        return [member['name'] for member in self.members]
+
+    def save(self):
+        tmp_path = os.path.join(self.path, INDEX + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump({'version': VERSION, 'members': self.members}, fd)
+        os.replace(tmp_path, os.path.join(self.path, INDEX))
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def _blob(self, blob):
+        # blobs are opened on the first read, pread doesn't share the file position across forked workers
+        fd = self._fds.get(blob)
+        if fd is None:
+            fd = self._fds[blob] = os.open(os.path.join(self.path, blob_name(blob)), os.O_RDONLY)
+        return fd
+
+    def member(self, key):
+        # by position or name
+        return self.members[key if isinstance(key, int) else self.positions[key]]
+
+    def _pread(self, blob, size, offset):
+        data = os.pread(self._blob(blob), size, offset)
+        if len(data) != size:
+            raise IOError('Truncated data at {} of {}'.format(offset, os.path.join(self.path, blob_name(blob))))
+        return data
+
+    def read(self, key):
+        member = self.member(key)
+        return self._pread(member['blob'], member['size'], member['offset'])
+
+    def open(self, key):
+        # file object of the encoded member, e.g. for PIL.Image.open
+        return BytesIO(self.read(key))
+
+    def iter_data(self, keys=None, chunk_size=64 << 20):
+        # yield the data of the members in the archive order (not the order of keys),
+        # contiguous members are read together in chunks, so the blobs are scanned sequentially
+        members = self.members if keys is None else [self.member(key) for key in keys]
+        members = sorted(members, key=lambda member: (member['blob'], member['offset']))
+        advised = set()
+        begin = 0
+        while begin < len(members):
+            first = members[begin]
+            end = begin + 1
+            stop = first['offset'] + first['size']
+            while end < len(members) and members[end]['blob'] == first['blob'] \
+                and members[end]['offset'] == stop and stop - first['offset'] < chunk_size:
+                stop += members[end]['size']
+                end += 1
+            if first['blob'] not in advised and hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self._blob(first['blob']), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                advised.add(first['blob'])
+            chunk = memoryview(self._pread(first['blob'], stop - first['offset'], first['offset']))
+            for member in members[begin : end]:
+                offset = member['offset'] - first['offset']
+                yield bytes(chunk[offset : offset + member['size']])
+            begin = end
+
+    def append(self, root, files, blob_size=1 << 32):
+        # append new or modified files (names relative to root), unchanged files are skipped
+        # the replaced data stays in the blobs, the index is only saved after the data is flushed
+        os.makedirs(self.path, exist_ok=True)
+        blob = max([member['blob'] for member in self.members], default=0)
+        blob_file = os.path.join(self.path, blob_name(blob))
+        offset = os.path.getsize(blob_file) if os.path.exists(blob_file) else 0
+        appended = 0
+        fd = None
+        try:
+            for file in files:
+                name = os.path.relpath(file, root).replace(os.sep, '/')
+                stat = os.stat(file)
+                pos = self.positions.get(name)
+                if pos is not None and self.members[pos]['size'] == stat.st_size \
+                    and self.members[pos]['mtime'] == stat.st_mtime_ns:
+                    continue
+                with open(file, 'rb') as src:
+                    data = src.read()
+                # start a new blob when full
+                if offset > 0 and offset + len(data) > blob_size:
+                    if fd is not None:
+                        fd.close()
+                        fd = None
+                    blob += 1
+                    offset = 0
+                if fd is None:
+                    fd = open(os.path.join(self.path, blob_name(blob)), 'ab')
+                fd.write(data)
+                member = {'name': name, 'blob': blob, 'offset': offset, 'size': len(data), 'mtime': stat.st_mtime_ns}
+                if pos is None:
+                    self.positions[name] = len(self.members)
+                    self.members.append(member)
+                else:
+                    self.members[pos] = member
+                offset += len(data)
+                appended += 1
+        finally:
+            if fd is not None:
+                fd.flush()
+                os.fsync(fd.fileno())
+                fd.close()
+            self.save()
+        return appended
+
+# one archive instance per process
+_archives = {}
+
+def get_archive(path):
+    archive = _archives.get(path)
+    if archive is None:
+        archive = _archives[path] = Archive(path)
+    return archive
+
+def main(argv):
+    import argparse
+    argp = argparse.ArgumentParser(argv[0])
+    argp.add_argument('input_dir')
+    argp.add_argument('archive')
+    argp.add_argument('--blob-size', type=int, default=4096) # MiB
+    args = argp.parse_args(argv[1:])
+    # pack the files in the sorted order, appending to an existing archive
+    files = listdir_files(args.input_dir, recursive=True, filter_ext=EXTS)
+    archive = Archive(args.archive)
+    appended = archive.append(args.input_dir, files, args.blob_size << 20)
+    eprint('Packed {} files into {}, {} members in total'.format(appended, args.archive, len(archive)))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import numpy as np
+from copy import copy
+from time import time, perf_counter
+from PIL import Image
+import dataset
+from dataset import TIMER, TimerReport, DataWriter, get_sampler, get_noise_bank, convert_dtype, regularize
+from dataset import pre_process, random_resize, random_noise, random_chroma, random_quantize
+from sampler import KERNELS, NOISES, CHROMAS, QUANTS
+
+# ======
+# benchmark of the degradation stages in dataset.py
+# stages and branches are timed on deterministic synthetic images at several resolutions,
+# results are written to JSON and optionally compared against a stored baseline
+
+def synthetic_image(width, height, seed=0):
+    # deterministic RGB image (HWC, uint8) with smooth gradients, hard edges and fine texture
+    rng = np.random.default_rng([seed, width, height])
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.empty((height, width, 3), np.float32)
+    for c in range(3):
+        fx, fy = rng.uniform(0.002, 0.05, 2)
+        img[:, :, c] = 0.5 + 0.25 * np.sin(x * fx + y * fy + rng.uniform(0, 2 * np.pi))
+    for _ in range(16):
+        top, left = rng.integers(0, height), rng.integers(0, width)
+        bottom, right = top + rng.integers(8, height // 2 + 9), left + rng.integers(8, width // 2 + 9)
+        img[top : bottom, left : right] = img[top : bottom, left : right] * 0.5 + rng.uniform(0, 0.5, 3)
+    img += rng.normal(0, 0.03, img.shape).astype(np.float32)
+    return np.uint8(np.clip(img, 0, 1) * 255 + 0.5)
+
+def branch_plans(config, field, branches, repeats, seed=0, index=None, size=65536):
+    # plans of each branch, taken from the sampled plans so that the branch parameters are realistic
+    plans = get_sampler(config.params).sample(np.random.default_rng(seed), size)
+    values = plans[field] if index is None else plans[field][:, index]
+    return {name: plans[values == i][:repeats] for i, name in enumerate(branches)}
+
+def measure(durations, name, func, plans):
+    # one warm-up run, then record the duration of each run
+    if len(plans) == 0:
+        return
+    func(plans[0])
+    for plan in plans:
+        start = perf_counter()
+        func(plan)
+        durations.setdefault(name, []).append(perf_counter() - start)
+
+def bench_stages(config, resolution, repeats, seed=0):
+    # durations of each branch of the random stages, on a CHW float32 image
+    width, height = resolution
+    img = regularize(synthetic_image(width, height, seed))
+    src = convert_dtype(img, np.float32)
+    durations = {}
+    prefix = '{}x{}/'.format(width, height)
+    # random_resize, downscale by 2 with each kernel
+    plans = branch_plans(config, 'kernel', KERNELS, repeats, seed, index=0)
+    for name in KERNELS:
+        measure(durations, prefix + 'random_resize/' + name,
+            lambda plan: random_resize(plan, 0, src, width // 2, height // 2, channel_first=True), plans[name])
+    # random_noise
+    param = config.params['random_noise']
+    bank = get_noise_bank(param, config.random_seed) if config.noise_bank else None
+    plans = branch_plans(config, 'noise', NOISES, repeats, seed)
+    for name in NOISES:
+        measure(durations, prefix + 'random_noise/' + name,
+            lambda plan: random_noise(param, plan, src, channel_first=True, bank=bank), plans[name])
+    # random_chroma
+    plans = branch_plans(config, 'chroma', CHROMAS, repeats, seed)
+    for name in CHROMAS:
+        measure(durations, prefix + 'random_chroma/' + name,
+            lambda plan: random_chroma(plan, src, channel_first=True), plans[name])
+    # random_quantize
+    plans = branch_plans(config, 'quant', QUANTS, repeats, seed)
+    for name in QUANTS:
+        measure(durations, prefix + 'random_quantize/' + name,
+            lambda plan: random_quantize(plan, src, np.float32, channel_first=True), plans[name])
+    return durations
+
+def bench_pre_process(config, resolution, repeats, seed=0):
+    # per-stage durations of pre_process on a patch of the given resolution
+    width, height = resolution
+    config = copy(config)
+    config.patch_width = width
+    config.patch_height = height
+    img = regularize(synthetic_image(width, height, seed))
+    plans = get_sampler(config.params).sample(np.random.default_rng(seed), repeats + 1)
+    dtype = np.dtype(config.dtype)
+    pre_process(config, img, dtype, 1, cropped=True, plan=plans[0])
+    TIMER.enabled = True
+    TIMER.snapshot()
+    for plan in plans[1:]:
+        with TIMER('pre_process'):
+            pre_process(config, img, dtype, 1, cropped=True, plan=plan)
+    TIMER.enabled = False
+    prefix = '{}x{}/pre_process/'.format(width, height)
+    return {prefix + name: durations for name, durations in TIMER.snapshot().items()}
+
+def bench_process(config, sources, batches, seed=0):
+    # end-to-end DataWriter.process in this process, return (samples/sec, per-stage durations)
+    import tempfile
+    config = copy(config)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ifiles = []
+        for index, (width, height) in enumerate(sources):
+            img = synthetic_image(width, height, seed + index)
+            for ext in ['.png', '.jpg']:
+                ifile = os.path.join(tmp_dir, '{}x{}{}'.format(width, height, ext))
+                Image.fromarray(img).save(ifile, quality=92)
+                ifiles.append(ifile)
+        sources_per_batch = DataWriter.get_sources(config)
+        tasks = [[ifiles[(step * sources_per_batch + i) % len(ifiles)] for i in range(sources_per_batch)]
+            for step in range(batches + 1)]
+        # warm-up
+        config.profile = False
+        DataWriter.process(config, tasks[0], os.path.join(tmp_dir, 'warmup.npz'), (seed, 0))
+        config.profile = True
+        durations = {}
+        tick = time()
+        for step, task in enumerate(tasks[1:]):
+            stats = DataWriter.process(config, task, os.path.join(tmp_dir, '{}.npz'.format(step)), (seed, step + 1))
+            for name, _durations in stats['timer'].items():
+                durations.setdefault('process/' + name, []).extend(_durations)
+        elapsed = time() - tick
+        TIMER.enabled = False
+    return batches * config.batch_size / elapsed, durations
+
+def synthetic_entries(count, max_distance, seed=0):
+    # curation entries of random pHashes, with near-duplicates (within and beyond max_distance) of the first tenth
+    rng = np.random.default_rng([seed, count, max_distance])
+    values = rng.integers(0, 1 << 64, count, dtype=np.uint64, endpoint=False)
+    for index in range(count // 10):
+        bits = rng.choice(64, rng.integers(0, max_distance + 3), replace=False)
+        values[count - 1 - index] = values[index] ^ np.uint64(sum(1 << int(bit) for bit in bits))
+    return {'{}.png'.format(index): {'phash': '{:016x}'.format(int(value)), 'width': 64, 'height': 64,
+        'jpeg_quality': None, 'sharpness': float(index)} for index, value in enumerate(values)}
+
+def bench_dedup(counts, distances, repeats, seed=0):
+    # durations of the near-duplicate search of the curation index
+    from curation import find_duplicates
+    durations = {}
+    for count in counts:
+        for max_distance in distances:
+            entries = synthetic_entries(count, max_distance, seed)
+            measure(durations, 'find_duplicates/{} d={}'.format(count, max_distance),
+                lambda _: find_duplicates(entries, max_distance), [None] * repeats)
+    return durations
+
+# heavy modules that should only be loaded where they are used
+HEAVY_MODULES = ['tensorflow', 'vapoursynth', 'zimg', 'webp', 'matplotlib']
+
+IMPORT_SCRIPT = '''
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import {}
+elapsed = perf_counter() - start
+heavy = [name for name in {} if name in sys.modules]
+# peak RSS of this process, ru_maxrss may be inherited from the parent across fork and exec
+rss = None
+with open('/proc/self/status') as fd:
+    for line in fd:
+        if line.startswith('VmHWM:'):
+            rss = int(line.split()[1])
+if rss is None:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([elapsed, rss, heavy]))
+'''
+
+def bench_imports(modules, repeats):
+    # import time and peak RSS (KB) of each module in a fresh interpreter, as a worker process would pay
+    import subprocess
+    durations = {}
+    imports = {}
+    for module in modules:
+        script = IMPORT_SCRIPT.format(module, HEAVY_MODULES)
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', script], check=True,
+                stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            elapsed, rss, heavy = json.loads(output.decode('utf-8').splitlines()[-1])
+            durations.setdefault('import/' + module, []).append(elapsed)
+        imports[module] = {'rss': rss, 'heavy': heavy}
+    return durations, imports
+
+def get_meta(config, args):
+    import platform
+    import hashlib
+    import PIL
+    params = json.dumps(config.params, sort_keys=True)
+    return {
+        'time': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'zimg': getattr(dataset.zimg, '__version__', None),
+        'params': args.params,
+        'params_sha1': hashlib.sha1(params.encode('utf-8')).hexdigest(),
+        'resolutions': args.resolutions,
+        'repeats': args.repeats
+    }
+
+def compare(results, baseline, tolerance):
+    # print the ratios to the baseline, return the list of regressions
+    regressions = []
+    lines = ['{:<56}{:>12}{:>12}{:>10}'.format('stage', 'base(ms)', 'mean(ms)', 'ratio')]
+    for name, stats in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        ratio = stats['mean'] / max(1e-9, base['mean'])
+        lines.append('{:<56}{:>12.3f}{:>12.3f}{:>10.3f}'.format(name, base['mean'], stats['mean'], ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    for name, speed in results['throughput'].items():
+        base = baseline['throughput'].get(name)
+        if base is None:
+            continue
+        ratio = speed / max(1e-9, base)
+        lines.append('{:<56}{:>12.3f}{:>12.3f}{:>10.3f}'.format(name + ' (samples/sec)', base, speed, ratio))
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    print('\n'.join(lines))
+    return regressions
+
+def main(argv):
+    import argparse
+    argp = argparse.ArgumentParser(argv[0])
+    argp.add_argument('--params', default='config/dataset.blur.json')
+    argp.add_argument('--output', default='benchmark.json')
+    argp.add_argument('--baseline') # JSON of a previous run to compare against
+    argp.add_argument('--tolerance', type=float, default=0.1) # relative slowdown reported as regression
+    argp.add_argument('--resolutions', type=int, nargs='+', default=[128, 256, 512]) # square patch sizes
+    argp.add_argument('--sources', nargs='+', default=['1280x720', '1920x1080', '3840x2160']) # source sizes for process
+    argp.add_argument('--repeats', type=int, default=20) # runs of each branch and pre_process
+    argp.add_argument('--batches', type=int, default=8) # batches of the end-to-end process
+    argp.add_argument('--seed', type=int, default=0)
+    argp.add_argument('--imports', nargs='*', default=['utils', 'shard', 'data', 'dataset']) # modules for the import benchmark
+    argp.add_argument('--import-repeats', type=int, default=5)
+    argp.add_argument('--dedup-counts', type=int, nargs='+', default=[5000, 20000]) # numbers of hashes
+    argp.add_argument('--dedup-distances', type=int, nargs='+', default=[4, 10]) # pHash distances
+    argp.add_argument('--dedup-repeats', type=int, default=3)
+    # the other arguments are passed to dataset.py, e.g. --batch-size, --dtype, --noise-bank
+    args, extras = argp.parse_known_args(argv[1:])
+    config = dataset.parse_args([argv[0], '', '', '--params', args.params, '--random-seed', str(args.seed)] + extras)
+    # run the benchmarks
+    report = TimerReport()
+    print('Benchmarking imports of {}'.format(', '.join(args.imports)))
+    durations, imports = bench_imports(args.imports, args.import_repeats)
+    report.merge(durations)
+    for size in args.resolutions:
+        print('Benchmarking stages at {}x{}'.format(size, size))
+        report.merge(bench_stages(config, (size, size), args.repeats, args.seed))
+        report.merge(bench_pre_process(config, (size, size), args.repeats, args.seed))
+    print('Benchmarking near-duplicate search')
+    report.merge(bench_dedup(args.dedup_counts, args.dedup_distances, args.dedup_repeats, args.seed))
+    print('Benchmarking DataWriter.process')
+    sources = [tuple(int(v) for v in source.split('x')) for source in args.sources]
+    speed, durations = bench_process(config, sources, args.batches, args.seed)
+    report.merge(durations)
+    results = {
+        'meta': get_meta(config, args),
+        'stages': report.summary(),
+        'throughput': {'process': speed},
+        'imports': imports
+    }
+    print(report)
+    for module, stats in imports.items():
+        print('import {}: {} KB max RSS, heavy modules loaded: {}'.format(
+            module, stats['rss'], ', '.join(stats['heavy']) or 'none'))
+    print('DataWriter.process: {} samples/sec'.format(speed))
+    with open(args.output, 'w') as fd:
+        json.dump(results, fd, indent=2)
+    # compare with the baseline
+    if args.baseline is not None:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        if baseline['meta'].get('params_sha1') != results['meta']['params_sha1']:
+            print('Warning: the baseline was run with different params')
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} regressions beyond {:.0%}: {}'.format(len(regressions), args.tolerance, ', '.join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,170 @@
+import os
+import numpy as np
+from source_index import SourceIndex
+
+# ======
+# corpus curation index
+# each entry holds the perceptual hashes, a sharpness score and a JPEG quality estimate of a source,
+# which are used to exclude near-duplicates and low-quality sources from the dataset
+
+# IJG standard luminance quantization table (quality 50)
+JPEG_LUMA = np.array([
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99
+])
+
+def jpeg_table_sums():
+    # sum of the scaled standard luminance table for quality in [1, 100]
+    quality = np.arange(1, 101)
+    scale = np.where(quality < 50, 5000 // quality, 200 - quality * 2)
+    tables = np.clip((JPEG_LUMA[None, :] * scale[:, None] + 50) // 100, 1, 255)
+    return tables.sum(axis=-1)
+
+JPEG_SUMS = jpeg_table_sums()
+
+def jpeg_quality(im):
+    # estimate the IJG quality from the luminance table, the sum is independent of the table order
+    tables = getattr(im, 'quantization', None)
+    if im.format != 'JPEG' or not tables:
+        return None
+    luma = np.sum(tables[min(tables)])
+    return int(np.argmin(np.abs(JPEG_SUMS - luma))) + 1
+
+def phash(gray):
+    # 64-bit DCT hash of a 32x32 grayscale image, as a hex string
+    from scipy.fft import dctn
+    coeffs = dctn(gray, norm='ortho')[:8, :8].flatten()
+    bits = coeffs > np.median(coeffs[1:])
+    return '{:016x}'.format(int(''.join('1' if bit else '0' for bit in bits), 2))
+
+def dhash(gray):
+    # 64-bit difference hash of a 9x8 grayscale image, as a hex string
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return '{:016x}'.format(int(''.join('1' if bit else '0' for bit in bits), 2))
+
+def sharpness(gray):
+    # variance of the Laplacian
+    from scipy import ndimage
+    return float(np.var(ndimage.laplace(gray)))
+
+def analyze(file, max_size=1024):
+    from PIL import Image
+    entry = {'size': -1, 'mtime': -1}
+    try:
+        stat = os.stat(file)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        with Image.open(file) as im:
+            entry['width'], entry['height'] = im.size
+            entry['jpeg_quality'] = jpeg_quality(im)
+            # the sharpness is measured at a bounded size, JPEG is reduced in the DCT domain
+            im.draft('L', (max_size, max_size))
+            im = im.convert('L')
+            if max(im.size) > max_size:
+                im.thumbnail((max_size, max_size), Image.BOX)
+            gray = np.asarray(im, np.float32)
+            entry['sharpness'] = sharpness(gray)
+            entry['phash'] = phash(np.asarray(im.resize((32, 32), Image.BOX), np.float32))
+            entry['dhash'] = dhash(np.asarray(im.resize((9, 8), Image.BOX), np.float32))
+    except Exception as err:
+        entry['error'] = str(err)
+    return entry
+
+def analyze_files(files):
+    return [analyze(file) for file in files]
+
+# number of set bits in each byte
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], np.uint8)
+
+def popcount(values):
+    # number of set bits of each uint64
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+def close_pairs(indices, values, max_distance, chunk_size=1024):
+    # (index1, index2) pairs with index1 < index2 of the bucket within max_distance, compared in vectorized blocks
+    pairs = []
+    for start in range(0, len(indices) - 1, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(indices)))
+        distances = popcount(values[rows, None] ^ values[None, start:])
+        # only the upper triangle
+        close = (distances <= max_distance) & (rows[:, None] < np.arange(start, len(indices))[None, :])
+        row, col = np.nonzero(close)
+        pairs.append(np.stack([indices[rows[row]], indices[start + col]], axis=-1))
+    return pairs
+
+def find_duplicates(entries, max_distance):
+    # group the files by the pHash within max_distance, return the files except the best one of each group
+    # candidates are found by LSH banding: split the 64 bits into max_distance+1 bands,
+    # two hashes within max_distance must have at least one identical band
+    files = list(entries)
+    values = np.array([int(entries[file]['phash'], 16) for file in files], np.uint64)
+    bands = min(64, max_distance + 1)
+    width = 64 // bands
+    # the candidates sharing a band are verified in each bucket
+    pairs = []
+    for band in range(bands):
+        keys = (values >> np.uint64(band * width)) & np.uint64((1 << width) - 1)
+        order = np.argsort(keys, kind='stable')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) > 1:
+                pairs += close_pairs(bucket, values[bucket], max_distance)
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.zeros((0, 2), np.int64)
+    # union-find of the verified pairs
+    parents = list(range(len(files)))
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+    for index1, index2 in pairs.tolist():
+        root1, root2 = find(index1), find(index2)
+        if root1 != root2:
+            parents[root2] = root1
+    groups = {}
+    for index, file in enumerate(files):
+        groups.setdefault(find(index), []).append(file)
+    # keep the one with the most pixels, then the highest JPEG quality (None: lossless), then the sharpest
+    def rank(file):
+        entry = entries[file]
+        quality = entry['jpeg_quality']
+        return (entry['width'] * entry['height'], 101 if quality is None else quality, entry['sharpness'])
+    duplicates = set()
+    for group in groups.values():
+        if len(group) > 1:
+            group.sort(key=rank, reverse=True)
+            duplicates.update(group[1:])
+    return duplicates
+
+class CurationIndex(SourceIndex):
+    read_entries = staticmethod(analyze_files)
+
+    def update(self, files, processes=8, chunk_size=32):
+        return super().update(files, processes, chunk_size)
+
+    def filter(self, files, min_sharpness=None, min_jpeg_quality=None, max_distance=None):
+        # return (kept files, {reason: number of excluded files})
+        excluded = {}
+        def exclude(reason, kept):
+            if len(kept) < len(files):
+                excluded[reason] = len(files) - len(kept)
+            return kept
+        files = exclude('unreadable', [file for file in files if self.readable(file)])
+        if min_sharpness is not None:
+            files = exclude('sharpness < {}'.format(min_sharpness),
+                [file for file in files if self.entries[file]['sharpness'] >= min_sharpness])
+        if min_jpeg_quality is not None:
+            files = exclude('JPEG quality < {}'.format(min_jpeg_quality),
+                [file for file in files if (self.entries[file]['jpeg_quality'] or 100) >= min_jpeg_quality])
+        if max_distance is not None:
+            duplicates = find_duplicates({file: self.entries[file] for file in files}, max_distance)
+            files = exclude('duplicates within distance {}'.format(max_distance),
+                [file for file in files if file not in duplicates])
+        return files, excluded
@@ -3,10 +3,14 @@ import numpy as np
 import os
 import random
 from utils import bool_argument, eprint, listdir_files
+import shard
+from ring import Ring
 
-def convert_dtype(img, dtype):
+def convert_dtype(img, dtype, out=None, value_range=(0, 1)):
+    # out: optional pre-allocated buffer for float conversion
+    # value_range: float range mapped to the full integer range when dequantizing
     src_dtype = img.dtype
-    if dtype == src_dtype: # skip same type
+    if dtype == src_dtype and out is None: # skip same type
         return img
     elif dtype == np.uint16:
         if src_dtype == np.uint8:
@@ -20,12 +24,20 @@ def convert_dtype(img, dtype):
         elif src_dtype != np.uint8:
             img = np.clip(img, 0, 1)
             img = np.uint8(img * 255 + 0.5)
+    elif src_dtype in (np.uint8, np.uint16): # dequantize straight into the float buffer
+        maxval = 255 if src_dtype == np.uint8 else 65535
+        low, high = value_range
+        if out is None:
+            out = np.empty(img.shape, dtype)
+        np.multiply(img, np.dtype(dtype).type((high - low) / maxval), out=out)
+        if low != 0:
+            out += np.dtype(dtype).type(low)
+        img = out
+    elif out is not None: # float to float
+        np.copyto(out, img)
+        img = out
     else: # assume float
         img = img.astype(dtype)
-        if src_dtype == np.uint8:
-            img *= (1 / 255)
-        elif src_dtype == np.uint16:
-            img *= (1 / 65535)
     # return
     return img
 
@@ -49,6 +61,7 @@ class DataBase:
         self.buffer_size = None
         self.shuffle = None
         self.mixup = None
+        self.ring = None
         # copy all the properties from config object
         self.config = config
         self.__dict__.update(config.__dict__)
@@ -68,6 +81,7 @@ class DataBase:
         argp.add_argument('--buffer-size', type=int, default=256)
         bool_argument(argp, 'shuffle', True)
         bool_argument(argp, 'mixup', False)
+        bool_argument(argp, 'ring', False) # the packed dataset is a ring filled by a running dataset.py --ring-size
 
     @staticmethod
     def parse_arguments(args):
@@ -77,21 +91,43 @@ class DataBase:
         def argchoose(name, cond, tv, fv):
             argdefault(name, tv if cond else fv)
         argchoose('batch_size', args.test, 1, 32)
-        # force packed data loader if enable mixup
-        if args.mixup:
+        # force packed data loader if enable mixup or ring
+        if args.mixup or args.ring:
             args.packed = True
 
+    def get_val_packed(self):
+        val_set = listdir_files(self.val_dir, recursive=True, filter_ext=['.npz', shard.EXT])
+        val_set = shard.list_batches(val_set)
+        self.val_steps = len(val_set)
+        self.val_size = self.val_steps * self.batch_size
+        self.val_set = val_set[:self.val_steps]
+        eprint('validation set: {}'.format(self.val_size))
+
+    def get_files_ring(self):
+        # the batches are taken from the ring as they are generated, an epoch is an epoch of the writer
+        # the validation set can only be in val_dir
+        assert self.val_size is None or self.val_dir is not None
+        if self.val_dir is not None:
+            self.get_val_packed()
+        meta = Ring(self.dataset).wait_meta()
+        self.epoch_steps = meta['epoch_steps']
+        self.epoch_size = self.epoch_steps * self.batch_size
+        if self.max_steps is None:
+            self.max_steps = self.epoch_steps * self.num_epochs
+        else:
+            self.num_epochs = (self.max_steps + self.epoch_steps - 1) // self.epoch_steps
+        self.main_set = None
+
     def get_files_packed(self):
-        data_list = listdir_files(self.dataset, recursive=True, filter_ext=['.npz'])
+        if self.ring:
+            return self.get_files_ring()
+        data_list = listdir_files(self.dataset, recursive=True, filter_ext=['.npz', shard.EXT])
+        data_list = shard.list_batches(data_list)
         if self.shuffle:
             random.shuffle(data_list)
         # val set
         if self.val_dir is not None:
-            val_set = listdir_files(self.val_dir, recursive=True, filter_ext=['.npz'])
-            self.val_steps = len(val_set)
-            self.val_size = self.val_steps * self.batch_size
-            self.val_set = val_set[:self.val_steps]
-            eprint('validation set: {}'.format(self.val_size))
+            self.get_val_packed()
         elif self.val_size is not None:
             self.val_steps = self.val_size // self.batch_size
             assert self.val_steps < len(data_list)
@@ -146,42 +182,80 @@ class DataBase:
     def process_sample(file, label, config):
         pass
 
+    @staticmethod
+    def dequantize(arrays, value_ranges):
+        # concat samples (CHW or NCHW) and convert straight into a float32 NCHW batch buffer
+        arrays = [a if len(a.shape) >= 4 else a[np.newaxis] for a in arrays]
+        count = sum(a.shape[0] for a in arrays)
+        out = np.empty((count,) + arrays[0].shape[1:], np.float32)
+        offset = 0
+        for a, value_range in zip(arrays, value_ranges):
+            convert_dtype(a, np.float32, out=out[offset : offset + a.shape[0]], value_range=value_range)
+            offset += a.shape[0]
+        return out
+
     @classmethod
     def extract_batch(cls, batch_set, config):
         # initialize
         inputs = []
         labels = []
+        value_ranges = []
         # load all data in the batch
         for file in batch_set:
-            with np.load(file) as npz:
-                _input = npz['inputs']
-                _label = npz['labels']
+            _input, _label, value_range = cls.load_packed(file)
             inputs.append(_input)
             labels.append(_label)
-        # concat data to form a batch (NCHW)
-        if len(inputs[0].shape) < 4:
-            inputs = np.stack(inputs, axis=0)
-        else:
-            inputs = np.concatenate(inputs, axis=0)
-        if len(labels[0].shape) < 4:
-            labels = np.stack(labels, axis=0)
-        else:
-            labels = np.concatenate(labels, axis=0)
-        # convert to float32
-        inputs = convert_dtype(inputs, np.float32)
-        labels = convert_dtype(labels, np.float32)
+            value_ranges.append(value_range)
+        # concat data to form a batch (NCHW) and convert to float32
+        inputs = cls.dequantize(inputs, value_ranges)
+        labels = cls.dequantize(labels, value_ranges)
         # return
         return inputs, labels
 
+    @staticmethod
+    def expand_variants(inputs, labels):
+        # NVCHW inputs (degraded variants sharing one label) => N*V training pairs
+        if len(inputs.shape) < 5:
+            return inputs, labels
+        variants = inputs.shape[1]
+        inputs = inputs.reshape((-1,) + inputs.shape[2:])
+        labels = np.repeat(labels, variants, axis=0)
+        return inputs, labels
+
     @classmethod
-    def extract_batch_packed(cls, batch_set):
-        # load the batch
+    def load_packed(cls, batch_set, retire=False):
+        # return inputs, labels and the value range of the stored data
+        # retire: delete the .npz file once loaded, for the batches taken from the ring
+        if isinstance(batch_set, tuple): # (shard file, batch index)
+            inputs, labels = shard.read_batch(*batch_set)
+            header = shard.open_shard(batch_set[0]).header
+            labels = cls.load_label_refs(labels, header)
+            return cls.expand_variants(inputs, labels) + (tuple(header.get('range', (0, 1))),)
         with np.load(batch_set) as npz:
             inputs = npz['inputs']
             labels = npz['labels']
+            value_range = tuple(npz['range']) if 'range' in npz.files else (0, 1)
+            attrs = {key: npz[key].tolist() for key in ('transfer', 'source_cache', 'patch_shape') if key in npz.files}
+        if retire:
+            os.remove(batch_set)
+        labels = cls.load_label_refs(labels, attrs)
+        return cls.expand_variants(inputs, labels) + (value_range,)
+
+    @staticmethod
+    def load_label_refs(labels, attrs):
+        # rebuild the labels stored as references into the source cache (dataset.py --label-refs)
+        if labels.dtype.names is None:
+            return labels
+        from dataset import load_label_refs
+        return load_label_refs(labels, attrs['source_cache'], attrs['patch_shape'], attrs['transfer'])
+
+    @classmethod
+    def extract_batch_packed(cls, batch_set, retire=False):
+        # load the batch
+        inputs, labels, value_range = cls.load_packed(batch_set, retire)
         # convert to float32
-        inputs = convert_dtype(inputs, np.float32)
-        labels = convert_dtype(labels, np.float32)
+        inputs = convert_dtype(inputs, np.float32, value_range=value_range)
+        labels = convert_dtype(labels, np.float32, value_range=value_range)
         # return
         return inputs, labels
 
@@ -197,19 +271,15 @@ class DataBase:
         return last
 
     @classmethod
-    def extract_batch_mixup(cls, batch_set, batch_set2):
+    def extract_batch_mixup(cls, batch_set, batch_set2, retire=False):
         # load the batch
-        with np.load(batch_set) as npz:
-            inputs = npz['inputs']
-            labels = npz['labels']
-        with np.load(batch_set2) as npz:
-            inputs2 = npz['inputs']
-            labels2 = npz['labels']
+        inputs, labels, value_range = cls.load_packed(batch_set, retire)
+        inputs2, labels2, value_range2 = cls.load_packed(batch_set2, retire)
         # convert to float32
-        inputs = convert_dtype(inputs, np.float32)
-        labels = convert_dtype(labels, np.float32)
-        inputs2 = convert_dtype(inputs2, np.float32)
-        labels2 = convert_dtype(labels2, np.float32)
+        inputs = convert_dtype(inputs, np.float32, value_range=value_range)
+        labels = convert_dtype(labels, np.float32, value_range=value_range)
+        inputs2 = convert_dtype(inputs2, np.float32, value_range=value_range2)
+        labels2 = convert_dtype(labels2, np.float32, value_range=value_range2)
         # linear to gamma
         inputs = cls.linear2gamma(inputs)
         inputs2 = cls.linear2gamma(inputs2)
@@ -257,6 +327,29 @@ class DataBase:
             for future in futures:
                 yield future.result()
 
+    def _gen_batches_ring(self, start=0):
+        # take the batches from the ring until max_steps, or until the writer stops
+        # the batches are retired by the loading processes, which makes room for the writer
+        ring = Ring(self.dataset)
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(self.processes) as executor:
+            futures = []
+            for step in range(start, self.max_steps):
+                batch_set = ring.take()
+                batch_set2 = ring.take() if self.mixup and batch_set is not None else None
+                if batch_set is None or (self.mixup and batch_set2 is None):
+                    break
+                if self.mixup:
+                    futures.append(executor.submit(self.extract_batch_mixup, batch_set, batch_set2, True))
+                else:
+                    futures.append(executor.submit(self.extract_batch_packed, batch_set, True))
+                # yield the data beyond prefetch range
+                while len(futures) >= self.prefetch:
+                    yield futures.pop(0).result()
+            # yield the remaining data
+            for future in futures:
+                yield future.result()
+
     def _gen_batches_origin(self, dataset, epoch_steps, num_epochs=1, start=0,
         shuffle=False):
         _dataset = dataset.copy()
@@ -295,6 +388,8 @@ class DataBase:
             return self._gen_batches_origin(dataset, epoch_steps, num_epochs, start, shuffle)
 
     def gen_main(self, start=0):
+        if self.ring:
+            return self._gen_batches_ring(start)
         return self._gen_batches(self.main_set, self.epoch_steps, self.num_epochs,
             start, self.shuffle)
 
@@ -1,17 +1,37 @@
 import os
 import random
+import itertools
 import numpy as np
 from scipy import ndimage
 from PIL import Image
 from io import BytesIO
-import webp
-import zimg
-from time import time
-from utils import eprint, reset_random, listdir_files, bool_argument
+from time import time, perf_counter
+from utils import LazyModule, eprint, reset_random, listdir_files, bool_argument, fsync_dir
+import shard
+from sampler import Sampler, PLAN_DTYPE, SCALES, NOISES, CHROMAS, QUANTS, TRANSFERS, MATRICES
+from sampler import CHROMA_FILTERS, SUBSAMPLINGS, QTABLES, kernel_name, kernel_filter
+from source_index import SourceIndex
+from curation import CurationIndex
+from archive import EXTS, is_archive, get_archive
+from pipeline import Pipeline
+from ring import Ring
+
+# the codec and resizer bindings are imported on first use, the dispatching process doesn't need them
+webp = LazyModule('webp')
+zimg = LazyModule('zimg')
 
 # NOTE: ZIMG implement BT709, BT601, BT2020 transfer as a gamma=2.4 curve, which differs from the standards
 
-def convert_dtype(img, dtype):
+def quantize(img, maxval, dtype, dither=False, rng=None):
+    img = np.clip(img, 0, 1)
+    if not dither:
+        return dtype(img * maxval + 0.5)
+    # triangular-PDF dither with the amplitude of 1 LSB
+    rng = np.random if rng is None else rng
+    img = img * maxval + rng.triangular(-1, 0, 1, img.shape)
+    return dtype(np.clip(img, 0, maxval) + 0.5)
+
+def convert_dtype(img, dtype, dither=False, rng=None):
     src_dtype = img.dtype
     if dtype == src_dtype: # skip same type
         return img
@@ -19,14 +39,12 @@ def convert_dtype(img, dtype):
         if src_dtype == np.uint8:
             img = np.uint16(img) * 257
         elif src_dtype != np.uint16:
-            img = np.clip(img, 0, 1)
-            img = np.uint16(img * 65535 + 0.5)
+            img = quantize(img, 65535, np.uint16, dither, rng)
     elif dtype == np.uint8:
         if src_dtype == np.uint16:
             img = np.uint8((np.int32(img) + 128) // 257)
         elif src_dtype != np.uint8:
-            img = np.clip(img, 0, 1)
-            img = np.uint8(img * 255 + 0.5)
+            img = quantize(img, 255, np.uint8, dither, rng)
     else: # assume float
         img = img.astype(dtype)
         if src_dtype == np.uint8:
@@ -36,92 +54,182 @@ def convert_dtype(img, dtype):
     # return
     return img
 
-def random_resize(param, src, dw, dh, roi_left=0, roi_top=0, roi_width=0, roi_height=0, channel_first=False):
-    rand_val = np.random.randint(0, 100)
-    if rand_val < param['Point']:
-        dst = zimg.resize(src, dw, dh, 'Point', channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    elif rand_val < param['Bilinear']:
-        dst = zimg.resize(src, dw, dh, 'Bilinear', channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    elif rand_val < param['Spline16']:
-        dst = zimg.resize(src, dw, dh, 'Spline16', channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    elif rand_val < param['Spline36']:
-        dst = zimg.resize(src, dw, dh, 'Spline36', channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    elif rand_val < param['Spline64']:
-        dst = zimg.resize(src, dw, dh, 'Spline64', channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    elif rand_val < param['Lanczos']: # Lanczos(taps=2~19)
-        taps = np.random.randint(2, 20)
-        dst = zimg.resize(src, dw, dh, 'Lanczos', taps, channel_first=channel_first,
-            roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
-    else: # Bicubic
-        if rand_val < param['Catmull-Rom']:
-            if rand_val < param['Hermite']: # Hermite
-                B = 0
-                C = 0
-            elif rand_val < param['B-Spline']: # B-Spline
-                B = 1
-                C = 0
-            elif rand_val < param['RobidouxSoft']: # Robidoux Soft
-                B = 0.67962275898295921 # (9-3*sqrt(2))/7
-                C = 0.1601886205085204 # 0.5 - B * 0.5
-            elif rand_val < param['Robidoux']: # Robidoux
-                B = 0.37821575509399866 # 12/(19+9*sqrt(2)
-                C = 0.31089212245300067 # 113/(58+216*sqrt(2))
-            elif rand_val < param['Mitchell']: # Mitchell
-                B = 1 / 3
-                C = 1 / 3
-            elif rand_val < param['RobidouxSharp']: # Robidoux Sharp
-                B = 0.2620145123990142 # 6/(13+7*sqrt(2))
-                C = 0.3689927438004929 # 7/(2+12*sqrt(2)
-            else: # Catmull-Rom
-                B = 0
-                C = 0.5
-            # randomly alternate the kernel with 80% probability
-            if np.random.randint(0, 10) > 1:
-                B += np.random.normal(0, 0.05)
-                C += np.random.normal(0, 0.05)
-        elif rand_val < param['SharpCubic']:
-            if rand_val < param['KeysCubic']: # Keys Cubic
-                B = np.random.uniform(0, 2 / 3) + np.random.normal(0, 1 / 3)
-                C = 0.5 - B * 0.5
-            elif rand_val < param['SoftCubic']: # Soft Cubic
-                B = np.random.uniform(0.5, 1) + np.random.normal(0, 0.25)
-                C = 1 - B
-            else: # Sharp Cubic
-                B = np.random.uniform(-0.75, -0.25) + np.random.normal(0, 0.25)
-                C = B * -0.5
-            # randomly alternate the kernel with 70%/90% probability
-            if np.random.randint(0, 10) > (2 if rand_val < param['KeysCubic'] else 0):
-                B += np.random.normal(0, 1 / 6)
-                C += np.random.normal(0, 1 / 6)
-        elif rand_val < param['ArtifactCubic']: # artifact Cubic
-            B = np.random.uniform(-1.5, 1.5) # amount of haloing
-            C = -1 # when c is around b * 0.8, aliasing is minimum
-            if B >= 0: # with aliasing
-                B = 1 + B
-                while C < 0 or C > B * 1.2:
-                    C = np.random.normal(B * 0.4, B * 0.2)
-            else: # without aliasing
-                B = 1 - B
-                while C < 0 or C > B * 1.2:
-                    C = np.random.normal(B * 0.8, B * 0.2)
-            B = -B
-            # randomly alternate the kernel
-            B += np.random.normal(0, 0.25)
-            C += np.random.normal(0, 0.25)
-        else: # arbitrary Bicubic
-            B = np.random.uniform(-2, 2) + np.random.normal(0, 0.5)
-            C = np.random.uniform(-1, 2) + np.random.normal(0, 0.5)
-        dst = zimg.resize(src, dw, dh, 'Bicubic', B, C, channel_first=channel_first,
+# ======
+# transfer conversion
+# a quantized source is converted to float32 and to the target transfer in one pass through a LUT,
+# the LUT is computed by zimg itself so that the result is the same as the two separate conversions
+
+_transfer_luts = {}
+
+def get_transfer_lut(dtype, transfer_in, transfer):
+    dtype = np.dtype(dtype)
+    key = (dtype.str, transfer_in, transfer)
+    lut = _transfer_luts.get(key)
+    if lut is None:
+        ramp = convert_dtype(np.arange(np.iinfo(dtype).max + 1, dtype=dtype), np.float32)
+        ramp = np.stack([ramp.reshape(1, -1)] * 3, axis=0)
+        ramp = zimg.convertFormat(ramp, channel_first=True, transfer_in=transfer_in, transfer=transfer)
+        lut = _transfer_luts[key] = np.ascontiguousarray(ramp[0, 0], np.float32)
+    return lut
+
+def convert_transfer(img, transfer_in, transfer, channel_first=False):
+    # convert to float32, and from transfer_in to transfer unless any of them is None
+    if transfer_in is None or transfer is None or transfer_in.upper() == transfer.upper():
+        return convert_dtype(img, np.float32)
+    if img.dtype in (np.uint8, np.uint16):
+        return np.take(get_transfer_lut(img.dtype, transfer_in, transfer), img)
+    img = convert_dtype(img, np.float32)
+    return zimg.convertFormat(img, channel_first=channel_first, transfer_in=transfer_in, transfer=transfer)
+
+# ======
+# per-stage timers
+# workers record the durations of each stage (and sampled branch),
+# which are merged in DataWriter.run into a periodic report
+
+class StageTimer:
+    class Stage:
+        def __init__(self, durations):
+            self.durations = durations
+
+        def __enter__(self):
+            self.start = perf_counter()
+
+        def __exit__(self, *args):
+            self.durations.append(perf_counter() - self.start)
+
+    class Null:
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *args):
+            pass
+
+    def __init__(self):
+        self.enabled = False
+        self.durations = {}
+        self.null = self.Null()
+
+    def __call__(self, name):
+        if not self.enabled:
+            return self.null
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations[name] = []
+        return self.Stage(durations)
+
+    def snapshot(self, reset=True):
+        durations = self.durations
+        if reset:
+            self.durations = {}
+        return durations
+
+# timer within each process
+TIMER = StageTimer()
+
+class TimerReport:
+    def __init__(self, capacity=10000):
+        # keep exact count and sum, and a bounded reservoir for percentiles
+        self.capacity = capacity
+        self.stats = {}
+        # own generator, the global random state orders the dataset in the main process
+        self.random = random.Random()
+
+    def merge(self, snapshot):
+        for name, durations in snapshot.items():
+            count, total, reservoir = self.stats.get(name, (0, 0.0, []))
+            for duration in durations:
+                count += 1
+                total += duration
+                if len(reservoir) < self.capacity:
+                    reservoir.append(duration)
+                else:
+                    index = self.random.randrange(count)
+                    if index < self.capacity:
+                        reservoir[index] = duration
+            self.stats[name] = (count, total, reservoir)
+
+    def summary(self):
+        # {stage: {count, mean, p50, p99}}, durations in ms
+        summary = {}
+        for name in sorted(self.stats):
+            count, total, reservoir = self.stats[name]
+            p50, p99 = np.percentile(reservoir, [50, 99]) * 1000
+            summary[name] = {'count': count, 'mean': total / count * 1000, 'p50': p50, 'p99': p99}
+        return summary
+
+    def __str__(self):
+        lines = ['{:<40}{:>10}{:>12}{:>12}{:>12}'.format('stage', 'count', 'mean(ms)', 'p50(ms)', 'p99(ms)')]
+        for name, stats in self.summary().items():
+            lines.append('{:<40}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+                name, stats['count'], stats['mean'], stats['p50'], stats['p99']))
+        return '\n'.join(lines)
+
+# ======
+# resizer plan cache
+# zimg.Resizer objects are reused for the same (shape, dtype, target, filter) combinations
+# float filter parameters are quantized to 1/quant so that random kernels can be reused
+
+class ResizerCache:
+    def __init__(self, capacity=256, quant=256):
+        from collections import OrderedDict
+        self.capacity = capacity
+        self.quant = quant
+        self.resizers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, value):
+        if isinstance(value, float):
+            return round(value * self.quant) / self.quant
+        return value
+
+    def get(self, src, dw, dh=None, channel_first=False, **kwargs):
+        # dh is None: create resizer by scaling ratio dw
+        kwargs = {k: self.quantize(v) for k, v in kwargs.items() if v is not None}
+        key = (src.shape, src.dtype.str, dw, dh, channel_first, tuple(sorted(kwargs.items())))
+        resizer = self.resizers.get(key)
+        if resizer is None:
+            self.misses += 1
+            if dh is None:
+                resizer = zimg.Resizer.createScale(src, dw, channel_first=channel_first, **kwargs)
+            else:
+                resizer = zimg.Resizer.create(src, dw, dh, channel_first=channel_first, **kwargs)
+            self.resizers[key] = resizer
+            if len(self.resizers) > self.capacity:
+                self.resizers.popitem(last=False)
+        else:
+            self.hits += 1
+            self.resizers.move_to_end(key)
+        return resizer
+
+    def stats(self, reset=False):
+        stats = {'hits': self.hits, 'misses': self.misses}
+        if reset:
+            self.hits = 0
+            self.misses = 0
+        return stats
+
+# shared by all the resize call sites within each process
+RESIZERS = ResizerCache()
+
+def resize(src, dw, dh, filter, filter_a=None, filter_b=None, channel_first=False,
+    roi_left=0, roi_top=0, roi_width=0, roi_height=0):
+    # only pass the non-default ROI
+    roi = {'roi_left': roi_left, 'roi_top': roi_top, 'roi_width': roi_width, 'roi_height': roi_height}
+    roi = {k: v for k, v in roi.items() if v != 0}
+    resizer = RESIZERS.get(src, dw, dh, channel_first=channel_first,
+        filter=filter, filter_a=filter_a, filter_b=filter_b, **roi)
+    return resizer(src)
+
+def random_resize(plan, index, src, dw, dh, roi_left=0, roi_top=0, roi_width=0, roi_height=0, channel_first=False):
+    # resize with the index-th kernel in the plan
+    filter, filter_a, filter_b = kernel_filter(plan, index)
+    with TIMER('random_resize/' + kernel_name(plan, index)):
+        dst = resize(src, dw, dh, filter, filter_a, filter_b, channel_first=channel_first,
             roi_left=roi_left, roi_top=roi_top, roi_width=roi_width, roi_height=roi_height)
     return dst
 
-def random_filter(params, src, dw=None, dh=None, channel_first=False):
-    param = params['random_filter']
+def random_filter(param, plan, src, dw=None, dh=None, channel_first=False):
     last = src
     sw = src.shape[-1 if channel_first else -2]
     sh = src.shape[-2 if channel_first else -3]
@@ -131,38 +239,126 @@ def random_filter(params, src, dw=None, dh=None, channel_first=False):
         dh = sh
     scale = np.sqrt((dw * dh) / (sw * sh))
     # random number for scaling
-    rand_val = np.random.randint(0, 100)
-    if rand_val < param['NoScale']: # no scale
+    branch = SCALES[plan['scale']]
+    if branch == 'NoScale': # no scale
         rand_scale = 0
-    elif rand_val < param['UpScale']: # up scale
+    elif branch == 'UpScale': # up scale
         max_scale = max(0, np.log2(scale)) + param['max_scale']
-        rand_scale = np.random.uniform(0, max_scale)
-    elif rand_val < param['DownScale']: # down scale
+        rand_scale = plan['scale_rand'] * max_scale
+    else: # down scale
         min_scale = min(0, np.log2(scale)) + param['min_scale']
-        rand_scale = np.random.uniform(min_scale, 0)
+        rand_scale = (1 - plan['scale_rand']) * min_scale
     rand_scale = 2 ** rand_scale # [0.25, 1) + [1, 2)
     # random resize
     if rand_scale != 1: # random scale
         tw = int(sw * rand_scale + 0.5)
         th = int(sh * rand_scale + 0.5)
         # print('{}x{} => {}x{} => {}x{}'.format(sw, sh, tw, th, dw, dh))
-        last = random_resize(params['random_resize'], last, tw, th,
+        last = random_resize(plan, 0, last, tw, th,
             channel_first=channel_first)
     if rand_scale != 1 or dw != sw or dh != sh: # scale to target size
-        last = random_resize(params['random_resize'], last, dw, dh,
+        last = random_resize(plan, 1, last, dw, dh,
             channel_first=channel_first)
     # return
     return last
 
-def random_noise(param, src, matrix=None, channel_first=False):
+# ======
+# correlated noise bank
+# float32 noise tiles are pre-generated for a grid of correlation sigmas,
+# noise is then sampled with the offsets and flips (from the plan) and scales from the tiles
+# opt-in (--noise-bank), as the distribution differs from the direct generation:
+# the correlation sigma is rounded to the step, and the noise repeats with the period of the tile size
+
+class NoiseBank:
+    def __init__(self, max_corr, step=0.125, size=512, seed=None):
+        self.step = step
+        self.size = size
+        self.count = int(np.ceil(max_corr / step)) + 1
+        # tiles are generated from the seed (None: 0), so that they are identical across workers and executors
+        self.seed = np.random.SeedSequence(0 if seed is None else seed).entropy
+        self.tiles = [None] * self.count
+
+    def get_tile(self, index):
+        tile = self.tiles[index]
+        if tile is None:
+            rng = np.random.default_rng([self.seed, index])
+            tile = rng.standard_normal((self.size, self.size), dtype=np.float32)
+            sigma = index * self.step
+            if sigma > 0: # periodic boundary, so that any offset can wrap around
+                tile = ndimage.gaussian_filter(tile, sigma, truncate=3.0, mode='wrap')
+            self.tiles[index] = tile
+        return tile
+
+    def sample(self, height, width, scale=1.0, corr=0.0, flip=0, offset=(0, 0)):
+        # flip: bits of transpose and flips, offset: (height, width) wrapped around the tile
+        index = min(self.count - 1, int(corr / self.step + 0.5))
+        tile = self.get_tile(index)
+        # transpose and flips
+        if flip & 1:
+            tile = tile.T
+        if flip & 2:
+            tile = tile[::-1]
+        if flip & 4:
+            tile = tile[:, ::-1]
+        # offsets
+        offset_height, offset_width = int(offset[0]) % self.size, int(offset[1]) % self.size
+        rows = (offset_height + np.arange(height)) % self.size
+        cols = (offset_width + np.arange(width)) % self.size
+        noise = tile[np.ix_(rows, cols)]
+        noise *= np.float32(scale)
+        return noise
+
+# one bank per worker for each noise_corr
+_noise_banks = {}
+
+# per-worker generator for the plans sampled in pre_process
+RNG = np.random.default_rng()
+
+def seed_sample(entropy):
+    # derive all the randomness of a sample from the entropy, e.g. (seed, epoch, step, index)
+    global RNG
+    seq = np.random.SeedSequence(entropy)
+    np.random.seed(seq.generate_state(4))
+    RNG = np.random.default_rng(seq.spawn(1)[0])
+
+# compiled sampler for each params
+_samplers = {}
+
+def get_sampler(params):
+    import json
+    key = json.dumps(params, sort_keys=True)
+    sampler = _samplers.get(key)
+    if sampler is None:
+        sampler = _samplers[key] = Sampler(params, len(webp.WebPPreset))
+    return sampler
+
+def get_noise_bank(param, seed=None):
+    key = (param['noise_corr'], seed)
+    bank = _noise_banks.get(key)
+    if bank is None:
+        bank = NoiseBank(param['noise_corr'] * 3, seed=seed)
+        _noise_banks[key] = bank
+    return bank
+
+def random_noise(param, plan, src, matrix=None, channel_first=False, bank=None):
+    # free of the global random state, so it may run in another thread or process
     if param['noise_str'] <= 0.0:
         return src
     last = src
     if matrix is None:
-        matrix = ['BT709', 'ST170_M', 'BT2020_NCL'][np.random.randint(0, 3)]
-    # noise generator
-    def noise_gen(shape, scale=0.01, corr=0.0, channel_first=False):
-        noise = np.random.normal(0.0, scale, shape).astype(np.float32)
+        matrix = MATRICES[plan['matrix']]
+    rng = np.random.default_rng(plan['noise_seed'])
+    # noise generator, plane: index of the (first) noise plane for the tile flips and offsets of the bank
+    def noise_gen(shape, scale=0.01, corr=0.0, channel_first=False, plane=0):
+        if bank is not None:
+            if len(shape) < 3:
+                return bank.sample(shape[0], shape[1], scale, corr,
+                    plan['noise_flip'][plane], plan['noise_offset'][plane])
+            height, width = shape[1:] if channel_first else shape[:-1]
+            noise = [bank.sample(height, width, scale, corr, plan['noise_flip'][plane + c], plan['noise_offset'][plane + c])
+                for c in range(shape[0 if channel_first else -1])]
+            return np.stack(noise, axis=0 if channel_first else -1)
+        noise = rng.normal(0.0, scale, shape).astype(np.float32)
         if corr > 0:
             corr = corr if len(shape) < 3 else [0, corr, corr] if channel_first else [corr, corr, 0]
             noise = ndimage.gaussian_filter(noise, corr, truncate=3.0)
@@ -170,73 +366,69 @@ def random_noise(param, src, matrix=None, channel_first=False):
     # noise shape, scale and spatial correlation
     shapeRGB = last.shape
     shapeY = last.shape[1:] if channel_first else last.shape[:-1]
-    corrY = np.abs(np.random.normal(0.0, param['noise_corr']))
-    corrY = 0 if corrY > param['noise_corr'] * 3 else corrY # no correlation if > sigma*3
-    scaleY = np.abs(np.random.normal(0.0, param['noise_str'])) * (1 + corrY)
-    corrC = np.abs(np.random.normal(0.0, param['noise_corr']))
-    corrC = 0 if corrC > param['noise_corr'] * 3 else corrC # no correlation if > sigma*3
-    scaleC = np.abs(np.random.normal(0.0, param['noise_str'])) * (1 + corrC)
+    corrY = plan['corr_y']
+    scaleY = plan['scale_y']
+    corrC = plan['corr_c']
+    scaleC = plan['scale_c']
     # noise type
-    rand_val = np.random.randint(0, 100)
-    # print('{}, Y: {}|{}, C: {}|{}'.format(rand_val, scaleY, corrY, scaleC, corrC))
-    if rand_val < param['NoNoise']:
+    branch = NOISES[plan['noise']]
+    if branch == 'NoNoise':
         pass
-    if rand_val < param['RGB']: # RGB noise
+    elif branch == 'RGB': # RGB noise
         noise = noise_gen(shapeRGB, scaleY, corrY, channel_first=channel_first)
-        last = last + noise
-    elif rand_val < param['YUV444']: # YUV444 noise
+        last = np.add(last, noise, out=noise)
+    elif branch == 'YUV444': # YUV444 noise
         noiseY = noise_gen(shapeY, scaleY, corrY, channel_first=channel_first)
-        noiseU = noise_gen(shapeY, scaleC, corrC, channel_first=channel_first)
-        noiseV = noise_gen(shapeY, scaleC, corrC, channel_first=channel_first)
+        noiseU = noise_gen(shapeY, scaleC, corrC, channel_first=channel_first, plane=1)
+        noiseV = noise_gen(shapeY, scaleC, corrC, channel_first=channel_first, plane=2)
         noise = np.stack([noiseY, noiseU, noiseV], axis=0 if channel_first else -1)
         noise = zimg.convertFormat(noise, channel_first=channel_first, matrix_in=matrix, matrix='rgb')
-        last = last + noise
-    elif rand_val < param['Y']: # Y noise
+        last = np.add(last, noise, out=noise)
+    elif branch == 'Y': # Y noise
         noiseY = noise_gen(shapeY, scaleY, corrY, channel_first=channel_first)
         noise = np.stack([noiseY] * 3, axis=0 if channel_first else -1)
-        last = last + noise
+        last = np.add(last, noise, out=noise)
     # return
     return last
 
-def random_chroma(param, src, matrix=None, channel_first=False):
+def random_chroma(plan, src, matrix=None, channel_first=False, transfer_in=None, transfer=None):
+    # the source is converted from transfer_in to transfer first, fused into the RGB to YUV conversion
     last = src
     sw = src.shape[-1 if channel_first else -2]
     sh = src.shape[-2 if channel_first else -3]
     if matrix is None:
-        matrix = ['BT709', 'ST170_M', 'BT2020_NCL'][np.random.randint(0, 3)]
-    filters = (
-        [{'filter': 'Bicubic', 'filter_a': 0, 'filter_b': 0.5}] * 3 +
-        [{'filter': 'Bicubic', 'filter_a': 1/3, 'filter_b': 1/3}] * 2 +
-        [{'filter': 'Bicubic', 'filter_a': 0.75, 'filter_b': 0.25},
-        {'filter': 'Bicubic', 'filter_a': 1.0, 'filter_b': 0.0},
-        {'filter': 'Point'}, {'filter': 'Bilinear'},
-        {'filter': 'Lanczos', 'filter_a': 3}]
-    )
-    # 0: YUV420, MPEG-1 chroma placement
-    # 1: YUV420, MPEG-2 chroma placement
-    # 2~5: RGB
-    rand_val = np.random.randint(0, 100)
+        matrix = MATRICES[plan['matrix']]
+    # chroma placement
+    # 0: MPEG-1 chroma placement
+    # 1: MPEG-2 chroma placement
+    place = plan['chroma_place']
     # chroma sub-sampling
-    if rand_val < param['RGB']:
-        pass
-    elif rand_val < param['YUV420']:
+    branch = CHROMAS[plan['chroma']]
+    transfers = {} if transfer_in is None or transfer is None else {'transfer_in': transfer_in, 'transfer': transfer}
+    if branch == 'RGB':
+        if transfers:
+            last = zimg.convertFormat(last, channel_first=channel_first, **transfers)
+    elif branch == 'YUV420':
         # convert RGB to YUV420
-        last = zimg.convertFormat(last, channel_first=channel_first, matrix_in='rgb', matrix=matrix)
-        lastY = last[0] if channel_first else last[:, :, 0]
+        last = zimg.convertFormat(last, channel_first=channel_first, matrix_in='rgb', matrix=matrix, **transfers)
         lastU = last[1] if channel_first else last[:, :, 1]
         lastV = last[2] if channel_first else last[:, :, 2]
-        filter_params = filters[np.random.randint(0, len(filters))]
-        resizer = zimg.Resizer.createScale(lastU, 0.5, **filter_params, channel_first=channel_first,
-            roi_left=0 if rand_val % 2 == 0 else -0.5)
+        filter_params = CHROMA_FILTERS[plan['chroma_down']]
+        resizer = RESIZERS.get(lastU, 0.5, **filter_params, channel_first=channel_first,
+            roi_left=0 if place == 0 else -0.5)
         lastU = resizer(lastU)
         lastV = resizer(lastV)
         # convert YUV420 to RGB
-        filter_params = filters[np.random.randint(0, len(filters))]
-        resizer = zimg.Resizer.create(lastU, sw, sh, **filter_params, channel_first=channel_first,
-            roi_left=0 if rand_val % 2 == 0 else 0.25)
-        lastU = resizer(lastU)
-        lastV = resizer(lastV)
-        last = np.stack((lastY, lastU, lastV), axis=0 if channel_first else -1)
+        filter_params = CHROMA_FILTERS[plan['chroma_up']]
+        resizer = RESIZERS.get(lastU, sw, sh, **filter_params, channel_first=channel_first,
+            roi_left=0 if place == 0 else 0.25)
+        # write back into the converted buffer
+        if channel_first:
+            last[1] = resizer(lastU)
+            last[2] = resizer(lastV)
+        else:
+            last[:, :, 1] = resizer(lastU)
+            last[:, :, 2] = resizer(lastV)
         last = zimg.convertFormat(last, channel_first=channel_first, matrix_in=matrix, matrix='rgb')
     # return
     return last
@@ -247,72 +439,72 @@ def linear_resize(src, dw, dh, transfer, channel_first=False):
     if transfer.upper() != 'LINEAR':
         last = zimg.convertFormat(last, channel_first=channel_first, transfer_in=transfer, transfer='LINEAR')
     # resize
-    last = zimg.resize(last, dw, dh, 'Bicubic', 0, 0.5, channel_first=channel_first)
+    last = resize(last, dw, dh, 'Bicubic', 0, 0.5, channel_first=channel_first)
     # convert back to gamma-corrected scale
     if transfer.upper() != 'LINEAR':
         last = zimg.convertFormat(last, channel_first=channel_first, transfer_in='LINEAR', transfer=transfer)
     # return
     return last
 
-def random_quantize(param, src, dtype=None, channel_first=False):
-    if dtype is None:
-        dtype = src.dtype
+# encoder configs reused across samples
+_webp_configs = {}
+_jpeg_qtables = {}
+
+def get_webp_config(preset, quality):
+    # quality is rounded to 0.1, which is finer than the encoder can tell apart
+    key = (preset, round(quality, 1))
+    config = _webp_configs.get(key)
+    if config is None:
+        config = _webp_configs[key] = webp.WebPConfig.new(preset=preset, quality=key[1], lossless=False)
+    return config
+
+def get_jpeg_qtables(name):
+    if name is None:
+        return None
+    qtables = _jpeg_qtables.get(name)
+    if qtables is None:
+        from PIL import JpegPresets
+        qtables = _jpeg_qtables[name] = JpegPresets.presets[name]['quantization']
+    return qtables
+
+def random_quantize(plan, src, dtype=None, channel_first=False, dither=False):
+    # free of the global random state, so it may run in another thread
+    # dtype None: the quantized 8-bit data is returned as is, or the source without quantization
     last = src
-    rand_val = np.random.randint(0, 100)
+    branch = QUANTS[plan['quant']]
     # if needed, convert to 8-bit
-    if rand_val >= param['NoQuant']:
+    if branch != 'NoQuant':
         last = convert_dtype(last, np.uint8)
     # if needed, convert CHW to HWC
-    if rand_val >= param['Quant8'] and channel_first:
+    encode = branch in ['WebP', 'JPEG']
+    if encode and channel_first:
         last = np.transpose(last, (1, 2, 0))
-    # randomly encode image
-    if rand_val < param['Quant8']:
-        pass
-    elif rand_val < param['WebP']: # WebP
-        preset = list(webp.WebPPreset)
-        preset = preset[np.random.randint(0, len(preset))]
-        # random quality in [0, 100) with gamma correction
-        # gamma > 1.0: bias towards small values
-        # 0.0 < gamma < 1.0: bias towards big values
-        gamma = param['webp_gamma']
-        quality = np.random.uniform(0, 100 ** (1 / gamma)) ** gamma
-        # print('WebP: preset={}, quality={}'.format(preset, quality))
-        # encode and decode
+    # encode and decode
+    if branch == 'WebP':
+        preset = list(webp.WebPPreset)[plan['preset']]
         last = np.copy(last, order='C')
         pic = webp.WebPPicture.from_numpy(last)
-        config = webp.WebPConfig.new(preset=preset, quality=quality, lossless=False)
-        data = pic.encode(config)
+        data = pic.encode(get_webp_config(preset, plan['quality']))
         last = data.decode(color_mode=webp.WebPColorMode.RGB)
-    elif rand_val < param['JPEG']: # JPEG
-        subsampling = ['4:4:4'] * 3 + ['4:2:2', '4:2:0']
-        subsampling = subsampling[np.random.randint(0, len(subsampling))]
-        qtables = [None, None, 'web_low', 'web_high']
-        qtables = qtables[np.random.randint(0, len(qtables))]
-        if qtables is None:
-            quality = 0
-            while not (1 <= quality <= 100):
-                quality = np.random.normal(param['jpeg_mean'], param['jpeg_std'])
-            quality = int(quality + 0.5)
-        else:
-            quality = np.random.randint(1, 101)
-        # print('JPEG: sub={}, qtables={}, quality={}'.format(subsampling, qtables, quality))
-        # encode and decode
+    elif branch == 'JPEG':
         with BytesIO() as buffer:
             im = Image.fromarray(last)
-            im.save(buffer, 'JPEG', subsampling=subsampling, quality=quality, qtables=qtables)
+            im.save(buffer, 'JPEG', subsampling=SUBSAMPLINGS[plan['subsampling']],
+                quality=int(plan['quality']), qtables=get_jpeg_qtables(QTABLES[plan['qtables']]))
             im = Image.open(buffer)
             last = np.array(im, copy=False)
     # if needed, convert HWC to CHW
-    if rand_val >= param['Quant8'] and channel_first:
+    if encode and channel_first:
         last = np.transpose(last, (2, 0, 1))
-    # convert to output dtype
-    last = convert_dtype(last, dtype)
+    # convert to output dtype, dithering with the seed in the plan
+    if dtype is not None:
+        rng = np.random.RandomState(plan['seed']) if dither else None
+        last = convert_dtype(last, dtype, dither, rng)
     # return
     return last
 
-def pre_process(config, img, dtype=np.float32):
-    channel_first = True
-    # image dimension regularization
+def regularize(img):
+    # image dimension regularization, HW/HWC => CHW with 3 channels
     rank = len(img.shape)
     if rank == 2:
         img = np.stack([img] * 3, axis=-3) # HW => CHW
@@ -325,8 +517,9 @@ def pre_process(config, img, dtype=np.float32):
         img = np.concatenate([img] * 3, axis=-3)
     elif channels == 4: # RGB with alpha
         img = img[0:3]
-    height = img.shape[-2]
-    width = img.shape[-1]
+    return img
+
+def get_pre_scale(config, width, height):
     # pre downscale ratio for high-resolution image
     pre_scale = 1
     if config.pre_down:
@@ -334,15 +527,49 @@ def pre_process(config, img, dtype=np.float32):
             pre_scale = 3
         elif (width >= 1536 and height >= 768) or (width >= 768 and height >= 1536):
             pre_scale = 2
-    # cropping
-    cropped_height = config.patch_height * pre_scale
-    cropped_width = config.patch_width * pre_scale
+    return pre_scale
+
+def crop_window(config, width, height, pre_scale):
+    # random crop window (offset_height, offset_width, cropped_height, cropped_width)
+    cropped_height = int(config.patch_height * pre_scale + 0.5)
+    cropped_width = int(config.patch_width * pre_scale + 0.5)
     offset_height = np.random.randint(0, height - cropped_height + 1) if height > cropped_height else 0
     offset_width = np.random.randint(0, width - cropped_width + 1) if width > cropped_width else 0
-    img = img[:, offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
-    height = min(height, cropped_height)
-    width = min(width, cropped_width)
-    # padding
+    return offset_height, offset_width, cropped_height, cropped_width
+
+def texture_window(config, img, pre_scale, regularized=True):
+    # sample texture_tries random windows, and pick one with the probability proportional to its detail
+    # the detail is the mean gradient energy, measured with an integral image on a strided copy
+    height, width = img.shape[-2:] if regularized else img.shape[:2]
+    windows = [crop_window(config, width, height, pre_scale) for _ in range(config.texture_tries)]
+    cropped_height, cropped_width = windows[0][2:]
+    stride = max(1, min(cropped_height, cropped_width) // 16)
+    if regularized:
+        gray = img[:, ::stride, ::stride].mean(axis=0, dtype=np.float32)
+    else:
+        gray = img[::stride, ::stride].astype(np.float32)
+        # the luminance of L/LA or RGB/RGBA, excluding the alpha
+        if gray.ndim == 3:
+            gray = gray[:, :, 0] if gray.shape[-1] < 3 else gray[:, :, :3].mean(axis=-1)
+    energy = np.zeros(gray.shape, np.float32)
+    energy[:, 1:] += np.abs(np.diff(gray, axis=1))
+    energy[1:, :] += np.abs(np.diff(gray, axis=0))
+    integral = np.zeros((energy.shape[0] + 1, energy.shape[1] + 1))
+    integral[1:, 1:] = energy.cumsum(axis=0).cumsum(axis=1)
+    weights = []
+    for offset_height, offset_width, _, _ in windows:
+        top = min(offset_height // stride, energy.shape[0] - 1)
+        left = min(offset_width // stride, energy.shape[1] - 1)
+        bottom = max(top + 1, min(energy.shape[0], (offset_height + cropped_height) // stride))
+        right = max(left + 1, min(energy.shape[1], (offset_width + cropped_width) // stride))
+        total = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+        weights.append(total / ((bottom - top) * (right - left)) + 1e-6)
+    weights = np.array(weights)
+    return windows[np.random.choice(len(windows), p=weights / weights.sum())]
+
+def pad_patch(img, cropped_height, cropped_width):
+    height = img.shape[-2]
+    width = img.shape[-1]
     if width < cropped_width or height < cropped_height:
         pad_height = max(0, cropped_height - height)
         pad_top = pad_height // 2
@@ -351,77 +578,550 @@ def pre_process(config, img, dtype=np.float32):
         pad_left = pad_width // 2
         pad_right = pad_width - pad_left
         img = np.pad(img, ((0, 0), (pad_top, pad_bottom), (pad_left, pad_right)), mode='reflect')
-        height = max(height, cropped_height)
-        width = max(width, cropped_width)
+    return img
+
+def random_crop(config, img, pre_scale=None, regularized=True):
+    # crop (and pad) an image, return the regularized CHW patch, pre_scale and the crop window
+    # a non-regularized HW/HWC image is cropped first, so the regularization only touches the patch
+    if regularized:
+        height = img.shape[-2]
+        width = img.shape[-1]
+    else:
+        height = img.shape[0]
+        width = img.shape[1]
+    # pre downscale ratio for high-resolution image
+    if pre_scale is None:
+        pre_scale = get_pre_scale(config, width, height)
+    # cropping
+    if config.texture_tries > 0:
+        window = texture_window(config, img, pre_scale, regularized)
+    else:
+        window = crop_window(config, width, height, pre_scale)
+    offset_height, offset_width, cropped_height, cropped_width = window
+    if regularized:
+        img = img[:, offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
+    else:
+        img = img[offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
+        img = regularize(img)
+    # padding
+    img = pad_patch(img, cropped_height, cropped_width)
+    return img, pre_scale, window
+
+def augment_patch(img, transpose, flip):
     # random transpose with 50% probability
-    if config.augment and np.random.randint(0, 2) > 0:
+    if transpose > 0:
         img = np.transpose(img, (0, 2, 1))
     # random flipping with 25% probability each
-    rand_val = np.random.randint(0, 4) if config.augment else 0
-    if rand_val == 1:
+    if flip == 1:
         img = img[:, :, ::-1]
-    elif rand_val == 2:
+    elif flip == 2:
         img = img[:, ::-1, :]
-    elif rand_val == 3:
+    elif flip == 3:
         img = img[:, ::-1, ::-1]
-    # convert to float32
-    img2 = convert_dtype(img, np.float32)
-    # random filter (input)
-    transfer = [None] * 3 + ['BT470_M', 'IEC_61966_2_1', 'IEC_61966_2_1']
-    transfer = transfer[np.random.randint(0, len(transfer))]
-    matrix = ['BT709'] * 3 + ['ST170_M', 'BT2020_NCL']
-    matrix = matrix[np.random.randint(0, len(matrix))]
-    _input = img2
-    # randomly convert to linear scale
-    if transfer is not None:
-        _input = zimg.convertFormat(_input, channel_first=channel_first, transfer_in=transfer, transfer='LINEAR')
-    # random filtering with resizer
-    _input = random_filter(config.params, _input,
-        config.patch_width // config.scale, config.patch_height // config.scale,
-        channel_first=channel_first)
-    # random noise
-    _input = random_noise(config.params['random_noise'], _input,
-        matrix=matrix, channel_first=channel_first)
-    # convert back to gamma-corrected scale
-    if transfer is not None:
-        _input = zimg.convertFormat(_input, channel_first=channel_first, transfer_in='LINEAR', transfer=transfer)
-    # random chroma sub-sampling
-    _input = random_chroma(config.params['random_chroma'], _input,
-        matrix=matrix, channel_first=channel_first)
-    # random quantize, gamma2linear, type conversion (input)
-    if config.linear:
-        _input = random_quantize(config.params['random_quantize'], _input,
-            np.float32, channel_first=channel_first)
-        _input = zimg.convertFormat(_input, channel_first=channel_first, transfer_in=config.transfer, transfer='LINEAR')
-        _input = convert_dtype(_input, dtype)
+    return img
+
+# ======
+# degradation stages of the input, run by pipeline.Pipeline in the order declared in params['pipeline']
+# each stage takes and returns the CHW data of a sample, the per-sample state is kept in the StageContext
+# the stages only draw from the generators seeded by the plan, so the result doesn't depend on the executor
+
+# without the declared stages, the codec round-trips run in the thread pool
+DEFAULT_PIPELINE = [
+    {'stage': 'random_filter'},
+    {'stage': 'random_noise'},
+    {'stage': 'random_chroma'},
+    {'stage': 'random_quantize', 'executor': 'thread'}
+]
+
+class StageContext:
+    # picklable for the process executor, only holds the settings read by the stages,
+    # not the whole config, which would be pickled again with every sample
+    def __init__(self, config, plan, params, dtype, channel_first=True):
+        self.plan = plan
+        self.filter_param = params['random_filter']
+        self.noise_param = params['random_noise']
+        self.dtype = dtype
+        self.channel_first = channel_first
+        self.width = config.patch_width // config.scale
+        self.height = config.patch_height // config.scale
+        self.noise_bank = config.noise_bank
+        self.random_seed = config.random_seed
+        self.dither = config.dither
+        # the output is converted from output_transfer to linear scale
+        self.output_transfer = config.transfer if config.linear else None
+        self.transfer = TRANSFERS[plan['transfer']]
+        self.matrix = MATRICES[plan['matrix']]
+        # the data is in linear scale after the conversion in pre_process
+        self.linear = self.transfer is not None
+
+def to_linear(context, data):
+    if context.transfer is not None and not context.linear:
+        context.linear = True
+        with TIMER('transfer'):
+            data = convert_transfer(data, context.transfer, 'LINEAR', context.channel_first)
+    return data
+
+def to_gamma(context, data):
+    if context.linear:
+        context.linear = False
+        with TIMER('transfer'):
+            data = convert_transfer(data, 'LINEAR', context.transfer, context.channel_first)
+    return data
+
+# the stages are timed along with the branches from the plan,
+# so the timing stays out of the degradations, which draw from the generators seeded by the plan
+
+def stage_filter(context, data):
+    # random filtering with resizer, in linear scale
+    data = to_linear(context, data)
+    with TIMER('random_filter'):
+        return random_filter(context.filter_param, context.plan, data,
+            context.width, context.height, channel_first=context.channel_first)
+
+def stage_noise(context, data):
+    # random noise, in linear scale
+    param = context.noise_param
+    data = to_linear(context, data)
+    with TIMER('random_noise'), TIMER('random_noise/' + NOISES[context.plan['noise']]):
+        bank = get_noise_bank(param, context.random_seed) if context.noise_bank else None
+        return random_noise(param, context.plan, data,
+            matrix=context.matrix, channel_first=context.channel_first, bank=bank)
+
+def stage_chroma(context, data):
+    # random chroma sub-sampling, converting back to gamma-corrected scale
+    linear = context.linear
+    context.linear = False
+    with TIMER('random_chroma'), TIMER('random_chroma/' + CHROMAS[context.plan['chroma']]):
+        return random_chroma(context.plan, data, matrix=context.matrix, channel_first=context.channel_first,
+            transfer_in='LINEAR' if linear else None, transfer=context.transfer)
+
+def stage_quantize(context, data):
+    # random quantize, free of the global random state
+    data = to_gamma(context, data)
+    with TIMER('random_quantize'), TIMER('random_quantize/' + QUANTS[context.plan['quant']]):
+        if context.output_transfer is not None:
+            # keep the quantized uint8 data, converted to linear scale with the LUT in stage_output
+            return random_quantize(context.plan, data,
+                None, channel_first=context.channel_first)
+        else:
+            return random_quantize(context.plan, data,
+                context.dtype, channel_first=context.channel_first, dither=context.dither)
+
+def stage_output(context, data):
+    # gamma2linear and type conversion, always appended to the last stage
+    data = to_gamma(context, data)
+    rng = np.random.RandomState(context.plan['seed']) if context.dither else None
+    if context.output_transfer is not None:
+        with TIMER('transfer'):
+            data = convert_transfer(data, context.output_transfer, 'LINEAR', context.channel_first)
+            data = convert_dtype(data, context.dtype, context.dither, rng)
     else:
-        _input = random_quantize(config.params['random_quantize'], _input,
-            dtype, channel_first=channel_first)
+        data = convert_dtype(data, context.dtype, context.dither, rng)
+    return data
+
+STAGES = {
+    'random_filter': stage_filter,
+    'random_noise': stage_noise,
+    'random_chroma': stage_chroma,
+    'random_quantize': stage_quantize,
+    'output': stage_output
+}
+
+_pipelines = {}
+
+def get_pipeline(config, params, inline=False):
+    # the thread stages without the number of workers use codec_threads, or run inline if codec_threads is 0
+    # inline: all the stages in the calling thread
+    import json
+    key = (json.dumps(params.get('pipeline'), sort_keys=True), config.codec_threads, inline)
+    pipeline = _pipelines.get(key)
+    if pipeline is None:
+        spec = params.get('pipeline', DEFAULT_PIPELINE)
+        spec = [{'stage': entry['stage']} if inline or (entry.get('executor') == 'thread'
+            and 'workers' not in entry and config.codec_threads <= 0) else dict(entry) for entry in spec]
+        # the final conversion joins the last stage
+        spec.append(dict(spec[-1], stage='output') if spec else {'stage': 'output'})
+        pipeline = _pipelines[key] = Pipeline(spec, STAGES, max(1, config.codec_threads))
+    return pipeline
+
+def pre_process(config, img, dtype=np.float32, pre_scale=None, regularized=False, cropped=False, pipeline=None,
+    plan=None, params=None, label=True):
+    # all the random decisions are taken from the plan, see sampler.PLAN_DTYPE
+    # pipeline: degradation stages of the input, defaults to all the stages in params inline
+    # params: degradation profile, defaults to config.params
+    # label: False to skip the label, e.g. for the extra variants of the same crop
+    channel_first = True
+    if params is None:
+        params = config.params
+    if pipeline is None:
+        pipeline = get_pipeline(config, params, inline=True)
+    if plan is None:
+        plan = get_sampler(params).sample(RNG, 1)[0]
+    if not cropped:
+        # cropping, dimension regularization and padding
+        img, pre_scale, _ = random_crop(config, img, pre_scale, regularized)
+    # random transpose and flipping
+    if config.augment:
+        img = augment_patch(img, plan['transpose'], plan['flip'])
+    # convert to float32 and randomly to linear scale
+    transfer = TRANSFERS[plan['transfer']]
+    with TIMER('transfer'):
+        _input = convert_transfer(img, transfer, 'LINEAR', channel_first)
+    # the label shares the converted source when the conversion is the same
+    shared = config.linear and transfer == config.transfer if transfer else not config.linear
+    img2 = _input if shared else None
+    # degradation stages, the remaining stages of the input are run later when they are pooled
+    job = pipeline.start(StageContext(config, plan, params, dtype, channel_first), _input)
+    _input = job.result() if job.done else job
     # pre downscale and type conversion (label)
+    if not label:
+        return _input, None
     _label = img2
-    if config.linear:
-        _label = zimg.convertFormat(_label, channel_first=channel_first, transfer_in=config.transfer, transfer='LINEAR')
+    if _label is None:
+        with TIMER('transfer'):
+            _label = convert_transfer(img, config.transfer, 'LINEAR' if config.linear else None, channel_first)
     if pre_scale != 1:
-        _label = linear_resize(_label, config.patch_width, config.patch_height,
-            'LINEAR' if config.linear else config.transfer, channel_first=channel_first)
-    _label = convert_dtype(_label, dtype)
+        with TIMER('linear_resize'):
+            _label = linear_resize(_label, config.patch_width, config.patch_height,
+                'LINEAR' if config.linear else config.transfer, channel_first=channel_first)
+    _label = convert_dtype(_label, dtype, config.dither)
     # return
-    return _input, _label # CHW, dtype
+    return _input, _label # CHW, dtype (the input is a pipeline.Job when it has pooled stages)
 
-def mixup(config, img1, img2, alpha=1.2, dtype=np.float32):
+def mixup(config, img1, img2, alpha=1.2, dtype=np.float32, pre_scales=(None, None), regularized=False, cropped=False, pipeline=None, plans=(None, None)):
     # process and mixup in float32
     inter_dtype = dtype if dtype in [np.float16, np.float32, np.float64] else np.float32
-    _input1, _label1 = pre_process(config, img1, inter_dtype)
-    _input2, _label2 = pre_process(config, img2, inter_dtype)
+    _input1, _label1 = pre_process(config, img1, inter_dtype, pre_scales[0], regularized, cropped, pipeline, plans[0])
+    _input2, _label2 = pre_process(config, img2, inter_dtype, pre_scales[1], regularized, cropped, pipeline, plans[1])
+    # the pooled stages of both inputs run concurrently
+    if not isinstance(_input1, np.ndarray):
+        _input1 = _input1.result()
+    if not isinstance(_input2, np.ndarray):
+        _input2 = _input2.result()
     _lambda = np.random.beta(alpha, alpha)
     _input = _lambda * _input1 + (1 - _lambda) * _input2
     _label = _lambda * _label1 + (1 - _lambda) * _label2
     # convert to output dtype
-    _input = convert_dtype(_input, dtype)
-    _label = convert_dtype(_label, dtype)
+    _input = convert_dtype(_input, dtype, config.dither)
+    _label = convert_dtype(_label, dtype, config.dither)
     # return
     return _input, _label # CHW, dtype
 
+# ======
+# ROI- and scale-aware decoding
+# the header is read first to determine pre_scale and the crop window before decoding
+
+def open_source(config, ifile):
+    # file name, or file object of the member in the packed archive
+    if config.archive is not None:
+        return get_archive(config.archive).open(ifile)
+    return ifile
+
+def truncate_png(im, bottom):
+    # stop the sequential decoding of a non-interlaced PNG at the row bottom, return whether it is applied
+    # it relies on PIL internals (the decoder tile and the size), so it is only applied when verified to work
+    if im.format != 'PNG' or im.info.get('interlace') or len(im.tile) != 1 or not png_truncate_supported():
+        return False
+    tile = im.tile[0]
+    if tuple(tile[1]) != (0, 0) + im.size:
+        return False
+    im.tile = [type(tile)(*((tile[0], (0, 0, im.size[0], bottom)) + tuple(tile[2:])))]
+    im._size = (im.size[0], bottom)
+    return True
+
+_png_truncate = None
+
+def png_truncate_supported():
+    # check once on a small PNG that the truncated decoding gives the top rows of the full decoding
+    global _png_truncate
+    if _png_truncate is None:
+        img = np.arange(8 * 4 * 3, dtype=np.uint8).reshape(8, 4, 3)
+        with BytesIO() as buffer:
+            Image.fromarray(img).save(buffer, 'PNG')
+            data = buffer.getvalue()
+        try:
+            im = Image.open(BytesIO(data))
+            tile = im.tile[0]
+            im.tile = [type(tile)(*((tile[0], (0, 0, 4, 3)) + tuple(tile[2:])))]
+            im._size = (4, 3)
+            _png_truncate = np.array_equal(np.array(im), img[:3])
+        except Exception:
+            _png_truncate = False
+    return _png_truncate
+
+def decode_patch(config, ifile):
+    # return the regularized CHW patch, its (effective) pre_scale and the crop window in the decoded image
+    im = Image.open(open_source(config, ifile))
+    width, height = im.size
+    pre_scale = get_pre_scale(config, width, height)
+    # JPEG: DCT-domain reduction by 1/2, 1/4 or 1/8 when pre-downscaling anyway (opt-in with --draft-decode),
+    # as it replaces (part of) the linear-light resizing of the label
+    if config.draft_decode and pre_scale != 1 and im.format == 'JPEG':
+        im.draft(im.mode, (width // pre_scale, height // pre_scale))
+        reduce = int(width / im.size[0] + 0.5)
+        if reduce > 1:
+            pre_scale = pre_scale // reduce if pre_scale % reduce == 0 else pre_scale / reduce
+            width, height = im.size
+    # crop window, the texture-aware window is picked after decoding the whole image
+    if config.texture_tries <= 0:
+        offset_height, offset_width, cropped_height, cropped_width = crop_window(config, width, height, pre_scale)
+        # non-interlaced PNG: stop the sequential decoding at the bottom of the crop window
+        # otherwise (or unsupported by PIL), the whole image is decoded
+        bottom = min(height, offset_height + cropped_height)
+        if bottom < height:
+            truncate_png(im, bottom)
+    with TIMER('decode'):
+        img = np.array(im, copy=False)
+    with TIMER('crop'):
+        if config.texture_tries > 0:
+            offset_height, offset_width, cropped_height, cropped_width = texture_window(
+                config, img, pre_scale, regularized=False)
+        img = img[offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
+        # image dimension regularization and padding
+        img = regularize(img)
+        img = pad_patch(img, cropped_height, cropped_width)
+    return img, pre_scale, (offset_height, offset_width, cropped_height, cropped_width)
+
+def load_patch(config, ifile):
+    # return the regularized CHW patch, its pre_scale and the crop window
+    if config.source_cache is not None:
+        with TIMER('decode'):
+            img, pre_scale = load_source(config, ifile)
+        with TIMER('crop'):
+            return random_crop(config, img, pre_scale)
+    elif config.roi_decode:
+        return decode_patch(config, ifile)
+    else:
+        with TIMER('decode'):
+            img = decode_source(config, ifile, regularized=False)
+        with TIMER('crop'):
+            return random_crop(config, img, regularized=False)
+
+def load_patches(config, ifile, seeds):
+    # lazily yield the regularized CHW patch, its pre_scale and the crop window for each seed
+    # the randomness of each crop is derived from its seed (None: continue the current state)
+    # with multiple crops, the source is decoded once and shared by all the crops
+    if len(seeds) == 1:
+        if seeds[0] is not None:
+            seed_sample(seeds[0])
+        yield load_patch(config, ifile)
+        return
+    with TIMER('decode'):
+        if config.source_cache is not None:
+            img, pre_scale = load_source(config, ifile)
+            regularized = True
+        else:
+            img = decode_source(config, ifile, regularized=False)
+            pre_scale = None
+            regularized = False
+    for seed in seeds:
+        if seed is not None:
+            seed_sample(seed)
+        with TIMER('crop'):
+            patch = random_crop(config, img, pre_scale, regularized)
+        yield patch
+
+# ======
+# decoded source cache
+# stores each decoded source as a regularized CHW array in .npy format, loaded with mmap
+# optionally pre-downscaled by the pre_scale, so the cached image is used with pre_scale=1
+
+def source_cache_path(config, ifile):
+    import hashlib
+    if config.archive is not None:
+        member = get_archive(config.archive).member(ifile)
+        source, size, mtime = os.path.join(os.path.abspath(config.archive), ifile), member['size'], member['mtime']
+    else:
+        stat = os.stat(ifile)
+        source, size, mtime = os.path.abspath(ifile), stat.st_size, stat.st_mtime_ns
+    # the cached content also depends on the pre downscaling (pre_down, transfer) when it is applied
+    key = '{}|{}|{}|{}|{}|{}'.format(source, size, mtime, config.cache_pre_down,
+        config.pre_down if config.cache_pre_down else '', config.transfer if config.cache_pre_down else '')
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(config.source_cache, digest[:2], digest + '.npy')
+
+def decode_source(config, ifile, regularized=True):
+    im = Image.open(open_source(config, ifile))
+    img = np.array(im, copy=False)
+    return regularize(img) if regularized else img
+
+def load_source(config, ifile):
+    # return regularized CHW image and its pre_scale (None: determined when cropping)
+    pre_scale = 1 if config.cache_pre_down else None
+    cache_file = source_cache_path(config, ifile)
+    try:
+        return np.load(cache_file, mmap_mode='r'), pre_scale
+    except (FileNotFoundError, ValueError):
+        pass
+    # decode and create cache
+    img = decode_source(config, ifile)
+    if config.cache_pre_down:
+        height = img.shape[-2]
+        width = img.shape[-1]
+        scale = get_pre_scale(config, width, height)
+        if scale != 1:
+            src_dtype = img.dtype
+            img = convert_dtype(img, np.float32)
+            img = linear_resize(img, int(width / scale + 0.5), int(height / scale + 0.5),
+                config.transfer, channel_first=True)
+            img = convert_dtype(img, src_dtype)
+    img = np.ascontiguousarray(img)
+    # write to a temporary file and atomically rename, other workers may load the same source
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as fd:
+        np.save(fd, img)
+    os.replace(tmp_file, cache_file)
+    return img, pre_scale
+
+# ======
+# label references
+# without linear conversion, the label is a crop of the cached source (optionally transposed and flipped),
+# which is stored as a reference into the source cache instead of the pixels and rebuilt when loading
+
+LABEL_REF_DTYPE = np.dtype([
+    ('source', 'S40'), # digest of the source cache file, empty for data with error
+    ('offset_height', '<u4'),
+    ('offset_width', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('transpose', 'u1'),
+    ('flip', 'u1'),
+    ('pre_scale', '<f4')
+])
+
+def make_label_ref(config, ifile, window, pre_scale, plan):
+    ref = np.zeros((), LABEL_REF_DTYPE)
+    ref['source'] = os.path.splitext(os.path.basename(source_cache_path(config, ifile)))[0]
+    ref['offset_height'], ref['offset_width'], ref['height'], ref['width'] = window
+    if config.augment:
+        ref['transpose'] = plan['transpose']
+        ref['flip'] = plan['flip']
+    ref['pre_scale'] = pre_scale
+    return ref
+
+def load_label_refs(refs, source_cache, patch_shape, transfer):
+    # rebuild the float32 labels in NCHW from the references into the source cache
+    labels = np.zeros((len(refs),) + tuple(patch_shape), np.float32)
+    for label, ref in zip(labels, refs):
+        if not ref['source']:
+            continue
+        digest = ref['source'].decode('ascii')
+        img = np.load(os.path.join(source_cache, digest[:2], digest + '.npy'), mmap_mode='r')
+        offset_height, offset_width = int(ref['offset_height']), int(ref['offset_width'])
+        cropped_height, cropped_width = int(ref['height']), int(ref['width'])
+        img = img[:, offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
+        img = pad_patch(img, cropped_height, cropped_width)
+        img = augment_patch(img, ref['transpose'], ref['flip'])
+        img = convert_dtype(img, np.float32)
+        if ref['pre_scale'] != 1:
+            img = linear_resize(img, patch_shape[-1], patch_shape[-2], transfer, channel_first=True)
+        label[...] = img
+    return labels
+
+# ======
+# append-only journal of the completed steps, in save_dir, one for each shard index of the partitioned output
+# a step is recorded only after its output is durably written (and renamed), and each record is synced,
+# so a restart skips the recorded steps in constant time and redoes the others, overwriting partial outputs
+
+class Journal:
+    FILE = 'journal.{}.log'
+
+    def __init__(self, save_dir, shard_index=0):
+        self.path = os.path.join(save_dir, self.FILE.format(shard_index))
+        self.done = set()
+        self.torn = False
+        self.fd = None
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as fd:
+                content = fd.read()
+            # the last line may be torn by a crash, only complete lines are trusted
+            lines = content.split('\n')
+            self.torn = lines[-1] != ''
+            for line in lines[:-1]:
+                fields = line.split()
+                if len(fields) == 2:
+                    self.done.add((int(fields[0]), int(fields[1])))
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def record(self, epoch, step):
+        if self.fd is None:
+            self.fd = open(self.path, 'a', encoding='utf-8')
+            fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+            if self.torn:
+                self.fd.write('\n')
+        self.fd.write('{} {}\n'.format(epoch, step))
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.done.add((epoch, step))
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+# ======
+# progress logging of the completed batches
+
+class ProgressLogger:
+    def __init__(self, config, total_steps):
+        self.config = config
+        self.total_steps = total_steps
+        self.completed = 0
+        self.skipped = 0
+        self.tick = time()
+        self.tick_completed = 0
+        self.resizer_stats = {'hits': 0, 'misses': 0}
+        self.timer_report = TimerReport()
+
+    def update(self, epoch, step, stats, last=False):
+        from datetime import timedelta
+        config = self.config
+        for key in self.resizer_stats:
+            self.resizer_stats[key] += stats['resizer'][key]
+        self.timer_report.merge(stats['timer'])
+        self.completed += 1
+        # log speed every log_freq, always log speed at the end
+        if not last and (config.log_freq <= 0 or self.completed % config.log_freq != 0):
+            return
+        tock = time()
+        speed = config.batch_size * (self.completed - self.tick_completed) / max(1e-9, tock - self.tick)
+        remaining = max(0, self.total_steps - self.completed - self.skipped)
+        eta = timedelta(seconds=int(remaining * config.batch_size / max(1e-9, speed)))
+        print('Epoch {} Step {}: {} samples/sec, {}/{} steps, ETA {}'.format(
+            epoch, step, speed, self.completed + self.skipped, self.total_steps, eta))
+        lookups = self.resizer_stats['hits'] + self.resizer_stats['misses']
+        print('Resizer cache: {:.2%} hit rate of {} lookups'.format(
+            self.resizer_stats['hits'] / max(1, lookups), lookups))
+        if config.profile:
+            print(self.timer_report)
+        self.tick = tock
+        self.tick_completed = self.completed
+
+# ======
+# worker states
+# the config is shipped once to each worker by the pool initializer,
+# so that each task only carries the file lists and seeds
+
+_worker_config = None
+_worker_slots = {}
+
+def init_worker(config):
+    global _worker_config
+    _worker_config = config
+    TIMER.enabled = config.profile
+
+def attach_slot(name):
+    # attach to the shared memory slot once per worker, kept open until the worker exits
+    slot = _worker_slots.get(name)
+    if slot is None:
+        from multiprocessing import shared_memory
+        slot = _worker_slots[name] = shared_memory.SharedMemory(name)
+    return slot.buf
+
 class DataWriter:
     def __init__(self, config):
         self.config = config
@@ -447,134 +1147,581 @@ class DataWriter:
 
     @classmethod
     def get_dataset(cls, config):
-        exts = ['.bmp', '.png', '.jpg', '.jpeg', '.webp', '.jp2', '.tiff']
-        dataset = listdir_files(config.input_dir, recursive=True, filter_ext=exts)
+        # the names of the members in a packed archive, or the files in the input directory
+        if config.archive is not None:
+            return get_archive(config.archive).names
+        dataset = listdir_files(config.input_dir, recursive=True, filter_ext=EXTS)
+        # skip unreadable files using the header index
+        if config.source_index is not None:
+            index = SourceIndex(config.source_index)
+            index.update(dataset, config.processes)
+            readable = [ifile for ifile in dataset if index.readable(ifile)]
+            if len(readable) < len(dataset):
+                eprint('Skipped {} unreadable files'.format(len(dataset) - len(readable)))
+            dataset = readable
+        # exclude near-duplicates and low-quality sources using the curation index
+        if config.curation_index is not None:
+            index = CurationIndex(config.curation_index)
+            index.update(dataset, config.processes)
+            dataset, excluded = index.filter(dataset, config.min_sharpness,
+                config.min_jpeg_quality, config.dedup_distance)
+            for reason, count in excluded.items():
+                eprint('Excluded {} files: {}'.format(count, reason))
         return dataset
 
     @staticmethod
-    def process(config, ifiles, ofile):
+    def get_costs(config, dataset, process_weight=16):
+        # {file: (pre_scale class, rough expected cost)}
+        # cost: decoded pixels, plus the pixels of the cropped patch
+        # weighted for the much heavier per-pixel processing after decoding
+        index = SourceIndex(config.source_index)
+        costs = {}
+        counts = {}
+        for ifile in dataset:
+            entry = index.get(ifile)
+            pre_scale = get_pre_scale(config, entry['width'], entry['height'])
+            patch_pixels = config.patch_width * config.patch_height * pre_scale * pre_scale
+            costs[ifile] = (pre_scale, entry['width'] * entry['height'] + process_weight * patch_pixels)
+            counts[pre_scale] = counts.get(pre_scale, 0) + 1
+        # statistics of pre_scale classes
+        for pre_scale in sorted(counts):
+            eprint('pre_scale={}: {} files'.format(pre_scale, counts[pre_scale]))
+        return costs
+
+    @classmethod
+    def balance_batches(cls, dataset, costs, batch_size, jitter=0.05):
+        # the batches are made within each pre_scale class, so that a batch takes a single decode path,
+        # then the batches of all the classes are shuffled together
+        # the leftovers of the classes are randomly picked, they fill the last batches with mixed classes
+        groups = {}
+        for ifile in dataset:
+            groups.setdefault(costs[ifile][0], []).append(ifile)
+        batches = []
+        leftovers = []
+        for pre_scale in sorted(groups):
+            _batches, _leftovers = cls.deal_batches(groups[pre_scale], costs, batch_size, jitter)
+            batches += _batches
+            leftovers += _leftovers
+        random.shuffle(batches)
+        random.shuffle(leftovers)
+        dataset[:] = [ifile for batch in batches for ifile in batch] + leftovers
+
+    @staticmethod
+    def deal_batches(files, costs, batch_size, jitter=0.05):
+        # return (batches, leftovers) of the files
+        # deal the files sorted by cost to the batches in snake order, so that each batch has a similar total cost
+        # the costs are randomly jittered (relative), so that the files of similar cost mix across epochs
+        order = files[:]
+        random.shuffle(order)
+        # the leftovers not fitting in a batch are randomly picked
+        num_batches = len(order) // batch_size
+        dealt = num_batches * batch_size
+        leftovers = order[dealt:]
+        order = sorted(order[:dealt], key=lambda ifile: costs[ifile][1] * (1 + jitter * random.random()), reverse=True)
+        batches = [[] for _ in range(num_batches)]
+        for i, ifile in enumerate(order):
+            rnd, pos = divmod(i, num_batches)
+            batches[pos if rnd % 2 == 0 else num_batches - 1 - pos].append(ifile)
+        for batch in batches:
+            random.shuffle(batch)
+        return batches, leftovers
+
+    @staticmethod
+    def get_sources(config):
+        # number of source files per batch, each source produces crops_per_image samples
+        return config.batch_size // config.crops_per_image
+
+    @staticmethod
+    def get_seeds(config, seed, index):
+        # seeds of the crops from the index-th source in the batch
+        crops = config.crops_per_image
+        return [None if seed is None else seed + (index * crops + crop,) for crop in range(crops)]
+
+    @staticmethod
+    def get_variants(config):
+        # number of degraded variants of each crop, for each profile
+        return len(config.profiles) * config.variants
+
+    @classmethod
+    def get_blanks(cls, config):
+        # zero (input, label) for data with error
         dtype = np.dtype(config.dtype)
+        input_shape, label_shape = cls.get_shapes(config)
+        return np.zeros(input_shape[-3:], dtype), np.zeros(label_shape, cls.get_label_dtype(config))
+
+    @classmethod
+    def resolve_inputs(cls, config, ifiles, inputs, labels):
+        # wait for the inputs with pooled stages, fill zero for data with error
+        variants = cls.get_variants(config)
+        for index, _input in enumerate(inputs):
+            if not isinstance(_input, np.ndarray):
+                try:
+                    inputs[index] = _input.result()
+                except Exception as err:
+                    import traceback
+                    ifile = ifiles[index // (config.crops_per_image * variants)]
+                    print('======\nError when processing {}\n{}\n{}\n------'.format(ifile, err, traceback.format_exc()))
+                    inputs[index], labels[index // variants] = cls.get_blanks(config)
+
+    @classmethod
+    def sample_plans(cls, config, seed, size):
+        # draw the degradation parameters of the whole batch in one pass, in the shape of (size, variants)
+        # the variants of the same crop share the augmentation, so that they have the same label
+        rng = np.random.default_rng(seed)
+        plans = np.empty((size, cls.get_variants(config)), PLAN_DTYPE)
+        with TIMER('sample'):
+            for index, params in enumerate(config.profiles):
+                begin = index * config.variants
+                end = begin + config.variants
+                plans[:, begin : end] = get_sampler(params).sample(rng, size * config.variants).reshape(size, -1)
+            plans['transpose'] = plans['transpose'][:, :1]
+            plans['flip'] = plans['flip'][:, :1]
+        return plans
+
+    @classmethod
+    def process_batch(cls, config, ifiles, seed=None):
+        # return (inputs, labels, plans)
+        # with multiple variants, inputs are in NVCHW and plans are in the shape of (N, V)
+        dtype = np.dtype(config.dtype)
+        variants = cls.get_variants(config)
+        plans = cls.sample_plans(config, seed, len(ifiles) * config.crops_per_image)
         inputs = []
         labels = []
-        for ifile in ifiles:
+        for index, ifile in enumerate(ifiles):
+            count = len(labels)
             try:
-                im = Image.open(ifile)
-                img = np.array(im, copy=False)
-                _input, _label = pre_process(config, img, dtype)
-                inputs.append(_input)
-                labels.append(_label)
+                for img, pre_scale, window in load_patches(config, ifile, cls.get_seeds(config, seed, index)):
+                    # record the crop into the plans
+                    plans['pre_scale'][len(labels)] = pre_scale
+                    plans['crop'][len(labels)] = window
+                    # apply each degradation profile to the same crop, sharing the label
+                    for variant in range(variants):
+                        params = config.profiles[variant // config.variants]
+                        _input, _label = pre_process(config, img, dtype, pre_scale, cropped=True,
+                            pipeline=get_pipeline(config, params), plan=plans[len(labels), variant],
+                            params=params, label=variant == 0 and not config.label_refs)
+                        inputs.append(_input)
+                        if variant == 0:
+                            label = _label
+                    if config.label_refs:
+                        label = make_label_ref(config, ifile, window, pre_scale, plans[len(labels), 0])
+                    labels.append(label)
             except Exception as err:
                 import traceback
                 print('======\nError when processing {}\n{}\n{}\n------'.format(ifile, err, traceback.format_exc()))
                 # fill zero for data with error
-                _blank = np.zeros((3, config.patch_height, config.patch_width), dtype)
-                inputs.append(_blank)
-                labels.append(_blank)
-        # CHW => NCHW
+                _input, _label = cls.get_blanks(config)
+                del inputs[count * variants:], labels[count:]
+                inputs += [_input] * (config.crops_per_image * variants)
+                labels += [_label] * config.crops_per_image
+        cls.resolve_inputs(config, ifiles, inputs, labels)
+        # CHW => NCHW (NVCHW)
         inputs = np.stack(inputs, axis=0)
         labels = np.stack(labels, axis=0)
-        np.savez_compressed(ofile, inputs=inputs, labels=labels)
+        if variants > 1:
+            inputs = inputs.reshape((labels.shape[0], variants) + inputs.shape[1:])
+        else:
+            plans = plans[:, 0]
+        return inputs, labels, plans
 
-    @staticmethod
-    def process_mixup(config, ifiles, ifiles2, ofile):
+    @classmethod
+    def process_batch_mixup(cls, config, ifiles, ifiles2, seed=None):
+        # return (inputs, labels, plans), with 2 plans for each sample
         dtype = np.dtype(config.dtype)
+        pipeline = get_pipeline(config, config.params)
+        plans = cls.sample_plans(config, seed, len(ifiles) * config.crops_per_image * 2)[:, 0].reshape(-1, 2)
         inputs = []
         labels = []
-        for ifile, ifile2 in zip(ifiles, ifiles2):
+        for index, (ifile, ifile2) in enumerate(zip(ifiles, ifiles2)):
+            count = len(inputs)
+            # the crops of the second source continue the random state of the first one
+            seeds = cls.get_seeds(config, seed, index)
+            patches = load_patches(config, ifile, seeds)
+            patches2 = load_patches(config, ifile2, [None] * len(seeds))
             try:
-                im = Image.open(ifile)
-                img = np.array(im, copy=False)
-                im2 = Image.open(ifile2)
-                img2 = np.array(im2, copy=False)
-                _input, _label = mixup(config, img, img2, dtype=dtype)
-                inputs.append(_input)
-                labels.append(_label)
+                for (img, pre_scale, window), (img2, pre_scale2, window2) in zip(patches, patches2):
+                    # record the crops into the plans
+                    plans['pre_scale'][len(inputs)] = pre_scale, pre_scale2
+                    plans['crop'][len(inputs)] = window, window2
+                    _input, _label = mixup(config, img, img2, dtype=dtype,
+                        pre_scales=(pre_scale, pre_scale2), cropped=True, pipeline=pipeline, plans=plans[len(inputs)])
+                    inputs.append(_input)
+                    labels.append(_label)
             except Exception as err:
                 print('======\nError when processing {}\n{}\n------'.format(ifile, err))
                 # fill zero for data with error
-                _blank = np.zeros((3, config.patch_height, config.patch_width), dtype)
-                inputs.append(_blank)
-                labels.append(_blank)
+                _input, _label = cls.get_blanks(config)
+                del inputs[count:], labels[count:]
+                inputs += [_input] * config.crops_per_image
+                labels += [_label] * config.crops_per_image
         # CHW => NCHW
         inputs = np.stack(inputs, axis=0)
         labels = np.stack(labels, axis=0)
-        np.savez_compressed(ofile, inputs=inputs, labels=labels)
+        return inputs, labels, plans
+
+    @staticmethod
+    def worker_stats():
+        return {'resizer': RESIZERS.stats(reset=True), 'timer': TIMER.snapshot()}
+
+    @classmethod
+    def process(cls, config, ifiles, ofile, seed=None):
+        # config is None: use the one shipped by the pool initializer
+        if config is None:
+            config = _worker_config
+        else:
+            TIMER.enabled = config.profile
+        inputs, labels, plans = cls.process_batch(config, ifiles, seed)
+        cls.save(config, ofile, inputs, labels, plans)
+        return cls.worker_stats()
+
+    @classmethod
+    def process_mixup(cls, config, ifiles, ifiles2, ofile, seed=None):
+        if config is None:
+            config = _worker_config
+        else:
+            TIMER.enabled = config.profile
+        inputs, labels, plans = cls.process_batch_mixup(config, ifiles, ifiles2, seed)
+        cls.save(config, ofile, inputs, labels, plans)
+        return cls.worker_stats()
+
+    @classmethod
+    def process_shm(cls, ifiles, ifiles2, slot, seed=None):
+        # in-memory mode: write the batch into the shared memory slot of the given name
+        config = _worker_config
+        if ifiles2 is None:
+            inputs, labels, plans = cls.process_batch(config, ifiles, seed)
+        else:
+            inputs, labels, plans = cls.process_batch_mixup(config, ifiles, ifiles2, seed)
+        buffer = attach_slot(slot)
+        np.ndarray(inputs.shape, inputs.dtype, buffer)[...] = inputs
+        np.ndarray(labels.shape, labels.dtype, buffer, inputs.nbytes)[...] = labels
+        return cls.worker_stats()
+
+    @classmethod
+    def get_attrs(cls, config):
+        # transfer and value range of the stored samples, used for dequantization when loading
+        # and the degradation profiles of the variants
+        attrs = {'transfer': 'LINEAR' if config.linear else config.transfer, 'range': [0.0, 1.0],
+            'profiles': config.profile_files, 'variants': config.variants}
+        # the labels are rebuilt from the source cache
+        if config.label_refs:
+            attrs['source_cache'] = os.path.abspath(config.source_cache)
+            attrs['patch_shape'] = [3, config.patch_height, config.patch_width]
+        return attrs
+
+    @staticmethod
+    def save(config, ofile, inputs, labels, plans=None):
+        # the degradation plans are optionally saved next to the batch
+        plans = plans if config.save_plans else None
+        with TIMER('write'):
+            if isinstance(ofile, tuple): # (shard file, batch index), attributes are in the header
+                if plans is not None:
+                    plans_dir = ofile[0] + '.plans'
+                    os.makedirs(plans_dir, exist_ok=True)
+                    np.save(os.path.join(plans_dir, '{}.npy'.format(ofile[1])), plans)
+                shard.write_batch(ofile[0], ofile[1], inputs, labels)
+            else:
+                # write to a temporary file and atomically rename, a crash never leaves a partial .npz
+                attrs = DataWriter.get_attrs(config)
+                extras = {} if plans is None else {'plans': plans}
+                if config.label_refs:
+                    extras['source_cache'] = np.array(attrs['source_cache'])
+                    extras['patch_shape'] = np.array(attrs['patch_shape'])
+                tmp_file = '{}.{}.tmp'.format(ofile, os.getpid())
+                with open(tmp_file, 'wb') as fd:
+                    np.savez_compressed(fd, inputs=inputs, labels=labels,
+                        transfer=np.array(attrs['transfer']), range=np.array(attrs['range'], np.float32), **extras)
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                os.replace(tmp_file, ofile)
+                fsync_dir(os.path.dirname(os.path.abspath(ofile)))
+
+    @classmethod
+    def get_shapes(cls, config):
+        # (input shape, label shape) of a sample in CHW, the input is in VCHW with multiple variants
+        # a label reference is a scalar of LABEL_REF_DTYPE
+        input_shape = (3, config.patch_height // config.scale, config.patch_width // config.scale)
+        label_shape = () if config.label_refs else (3, config.patch_height, config.patch_width)
+        variants = cls.get_variants(config)
+        if variants > 1:
+            input_shape = (variants,) + input_shape
+        return input_shape, label_shape
+
+    @staticmethod
+    def get_label_dtype(config):
+        return LABEL_REF_DTYPE if config.label_refs else np.dtype(config.dtype)
+
+    @staticmethod
+    def get_units(config, epoch_steps):
+        # output files are the units of partitioning, return (number of units, steps per unit)
+        unit_steps = 1 if config.format == 'npz' else config.shard_size
+        return (epoch_steps + unit_steps - 1) // unit_steps, unit_steps
+
+    @classmethod
+    def in_partition(cls, config, epoch, unit, epoch_steps):
+        # deterministically assign the units to the nodes in a round-robin way
+        units = cls.get_units(config, epoch_steps)[0]
+        return (epoch * units + unit) % config.num_shards == config.shard_index
+
+    @classmethod
+    def get_outputs(cls, config, odir, epoch, epoch_steps):
+        # list of (step, output) for each step within an epoch, in this partition
+        # the completed steps are taken from the journal, not from the existing outputs
+        units, unit_steps = cls.get_units(config, epoch_steps)
+        unit_width = len(str(units))
+        if config.format == 'npz':
+            outputs = []
+            for step in range(epoch_steps):
+                if not cls.in_partition(config, epoch, step, epoch_steps):
+                    continue
+                ofile = os.path.join(odir, '{:0>{width}}.npz'.format(step, width=unit_width))
+                outputs.append((step, ofile))
+            return outputs
+        # sharded container, each shard holds up to shard_size batches
+        dtype = np.dtype(config.dtype)
+        input_shape, label_shape = cls.get_shapes(config)
+        outputs = []
+        for index in range(units):
+            if not cls.in_partition(config, epoch, index, epoch_steps):
+                continue
+            ofile = os.path.join(odir, '{:0>{width}}{}'.format(index, shard.EXT, width=unit_width))
+            batches = min(unit_steps, epoch_steps - index * unit_steps)
+            if not os.path.exists(ofile):
+                shard.create_shard(ofile, batches, config.batch_size,
+                    input_shape, label_shape, dtype, cls.get_label_dtype(config), **cls.get_attrs(config))
+            outputs += [(index * unit_steps + i, (ofile, i)) for i in range(batches)]
+        return outputs
+
+    @classmethod
+    def gen_tasks(cls, config, dataset, dataset2, epoch_steps, progress, costs=None, save=True, journal=None):
+        # lazily generate (epoch, step, output, ifiles, ifiles2, seed) across all the epochs
+        # output is None when not saving (in-memory and ring modes), ifiles2 is None without mixup
+        # the steps completed in the journal are skipped
+        # epochs <= 0: endless, only for the ring
+        epochs = config.epochs
+        unit_steps = cls.get_units(config, epoch_steps)[1]
+        for epoch in (range(epochs) if epochs > 0 else itertools.count()):
+            if save:
+                # create directory for each epoch
+                odir = os.path.join(config.save_dir, '{:0>{width}}'.format(epoch, width=len(str(epochs))))
+                if not os.path.exists(odir):
+                    print('Create directory: ', odir)
+                    os.makedirs(odir)
+            # randomly shuffle for each epoch
+            # the submitted tasks hold copies of the slices, so in-place shuffle is safe
+            if config.shuffle == 2:
+                random.shuffle(dataset)
+                random.shuffle(dataset2)
+            if costs is not None and (config.shuffle == 2 or epoch == 0):
+                cls.balance_batches(dataset, costs, cls.get_sources(config))
+            if save:
+                outputs = cls.get_outputs(config, odir, epoch, epoch_steps)
+            else:
+                outputs = [(step, None) for step in range(epoch_steps)
+                    if cls.in_partition(config, epoch, step // unit_steps, epoch_steps)]
+            for step, ofile in outputs:
+                # skip completed steps
+                if journal is not None and (epoch, step) in journal:
+                    progress['skipped'] += 1
+                    continue
+                begin = step * cls.get_sources(config)
+                end = begin + cls.get_sources(config)
+                ifiles = dataset[begin : end]
+                ifiles2 = dataset2[begin : end] if config.mixup else None
+                seed = None if config.random_seed is None else (config.random_seed, epoch, step)
+                yield epoch, step, ofile, ifiles, ifiles2, seed
 
     @classmethod
-    def run(cls, config, dataset):
+    def prepare(cls, config, dataset):
+        # return (dataset, dataset2, epoch steps, progress, total steps) for generating the tasks
         _dataset = dataset.copy()
         _dataset2 = dataset.copy()
         epochs = config.epochs
-        epoch_steps = len(_dataset) // config.batch_size
-        step_width = len(str(epoch_steps))
+        epoch_steps = len(_dataset) // cls.get_sources(config)
+        units, unit_steps = cls.get_units(config, epoch_steps)
+        total_steps = sum(min(unit_steps, epoch_steps - unit * unit_steps)
+            for epoch in range(epochs) for unit in range(units)
+            if cls.in_partition(config, epoch, unit, epoch_steps))
         # pre-shuffle the dataset
         if config.shuffle == 1:
             random.shuffle(_dataset)
             random.shuffle(_dataset2)
+        progress = {'skipped': 0}
+        return _dataset, _dataset2, epoch_steps, progress, total_steps
+
+    @staticmethod
+    def get_max_pending(config):
+        return config.max_pending if config.max_pending > 0 else config.processes * 4
+
+    @classmethod
+    def run(cls, config, dataset, costs=None):
+        _dataset, _dataset2, epoch_steps, progress, total_steps = cls.prepare(config, dataset)
+        # bounded number of in-flight tasks, spanning epoch boundaries
+        max_pending = cls.get_max_pending(config)
+        # ring mode: the batches are written into the ring in save_dir instead of the epoch directories
+        ring = None
+        journal = None
+        if config.ring_size > 0:
+            ring = Ring(config.save_dir)
+            ring.start(epoch_steps=epoch_steps, batch_size=config.batch_size, size=config.ring_size)
+        else:
+            journal = Journal(config.save_dir, config.shard_index)
+        tasks = cls.gen_tasks(config, _dataset, _dataset2, epoch_steps, progress, costs,
+            save=ring is None, journal=journal)
         # execute pre-process
-        from concurrent.futures import ProcessPoolExecutor
-        with ProcessPoolExecutor(config.processes) as executor:
+        # the config is shipped once to each worker, tasks only carry the file lists and seeds
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        with ProcessPoolExecutor(config.processes, initializer=init_worker, initargs=(config,)) as executor:
+            pending = {}
+            exhausted = False
             skipped = 0
-            for epoch in range(epochs):
-                # create directory for each epoch
-                odir = os.path.join(config.save_dir, '{:0>{width}}'.format(epoch, width=len(str(epochs))))
-                if not os.path.exists(odir):
-                    print('Create directory: ', odir)
-                    os.makedirs(odir)
-                # randomly shuffle for each epoch
-                if config.shuffle == 2:
-                    random.shuffle(_dataset)
-                    random.shuffle(_dataset2)
-                # loop over the batches and append the calls
-                futures = []
-                for step in range(epoch_steps):
-                    ofile = os.path.join(odir, '{:0>{width}}.npz'.format(step, width=step_width))
-                    # skip existing files
-                    if not os.path.exists(ofile):
-                        if skipped > 0:
-                            print('Skipped {} existed output files'.format(skipped))
-                            skipped = 0
-                        begin = step * config.batch_size
-                        end = begin + config.batch_size
-                        ifiles = _dataset[begin : end]
-                        if config.mixup:
-                            ifiles2 = _dataset2[begin : end]
-                            futures.append(executor.submit(cls.process_mixup, config, ifiles, ifiles2, ofile))
-                        else:
-                            futures.append(executor.submit(cls.process, config, ifiles, ofile))
+            logger = ProgressLogger(config, total_steps)
+            while True:
+                # keep the window filled
+                while not exhausted and len(pending) < max_pending:
+                    # backpressure: the ring holds at most ring_size batches, including the pending ones
+                    if ring is not None and ring.count() + len(pending) >= config.ring_size:
+                        break
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    epoch, step, ofile, ifiles, ifiles2, seed = task
+                    if ring is not None:
+                        ofile = ring.next_path()
+                    if ifiles2 is None:
+                        future = executor.submit(cls.process, None, ifiles, ofile, seed)
                     else:
-                        skipped += 1
-                # execute the calls
-                step = 0
-                tick = time()
-                for future in futures:
-                    future.result()
-                    # log speed every log_freq, always log speed at the end of each epoch
-                    if (config.log_freq > 0 and step % config.log_freq == 0) or (step == len(futures) - 1):
-                        tock = time()
-                        speed = (config.batch_size * config.log_freq) / max(1e-9, tock - tick)
-                        print('Epoch {} Step {}: {} samples/sec'.format(epoch, step, speed))
-                        tick = time()
-                    step += 1
+                        future = executor.submit(cls.process_mixup, None, ifiles, ifiles2, ofile, seed)
+                    pending[future] = (epoch, step)
+                # report skipped files
+                if progress['skipped'] > skipped:
+                    print('Skipped {} completed steps in the journal'.format(progress['skipped'] - skipped))
+                    skipped = progress['skipped']
+                    logger.skipped = skipped
+                if not pending:
+                    if exhausted:
+                        break
+                    # the ring is full, wait for the consumer
+                    ring.wait(config.ring_size)
+                    continue
+                # wait for any task to complete
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    epoch, step = pending.pop(future)
+                    stats = future.result()
+                    if journal is not None:
+                        journal.record(epoch, step)
+                    logger.update(epoch, step, stats, exhausted and not pending)
+        if ring is not None:
+            ring.stop()
+        else:
+            journal.close()
+
+    @classmethod
+    def iterate(cls, config, dataset, costs=None):
+        # in-memory mode: yield (epoch, step, inputs, labels) in order without writing any file
+        # each batch is written by the workers into one of max_pending shared memory slots,
+        # the yielded arrays are views of the slot, only valid until the next iteration
+        from multiprocessing import shared_memory
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+        _dataset, _dataset2, epoch_steps, progress, total_steps = cls.prepare(config, dataset)
+        max_pending = cls.get_max_pending(config)
+        tasks = cls.gen_tasks(config, _dataset, _dataset2, epoch_steps, progress, costs, save=False)
+        dtype = np.dtype(config.dtype)
+        input_shape, label_shape = cls.get_shapes(config)
+        input_shape = (config.batch_size,) + input_shape
+        label_shape = (config.batch_size,) + label_shape
+        input_bytes = int(np.prod(input_shape)) * dtype.itemsize
+        label_dtype = cls.get_label_dtype(config)
+        label_bytes = int(np.prod(label_shape)) * label_dtype.itemsize
+        slots = [shared_memory.SharedMemory(create=True, size=input_bytes + label_bytes)
+            for _ in range(max_pending)]
+        try:
+            with ProcessPoolExecutor(config.processes, initializer=init_worker, initargs=(config,)) as executor:
+                free = deque(range(max_pending))
+                pending = deque()
+                held = None
+                logger = ProgressLogger(config, total_steps)
+                while True:
+                    # the slot of the previously yielded batch is released
+                    if held is not None:
+                        free.append(held)
+                        held = None
+                    # keep the window filled
+                    while free:
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        epoch, step, _, ifiles, ifiles2, seed = task
+                        slot = free.popleft()
+                        future = executor.submit(cls.process_shm, ifiles, ifiles2, slots[slot].name, seed)
+                        pending.append((future, slot, epoch, step))
+                    if not pending:
+                        break
+                    # yield in submission order
+                    future, slot, epoch, step = pending.popleft()
+                    logger.update(epoch, step, future.result(), not pending)
+                    held = slot
+                    buffer = slots[slot].buf
+                    inputs = np.ndarray(input_shape, dtype, buffer)
+                    labels = np.ndarray(label_shape, label_dtype, buffer, input_bytes)
+                    yield epoch, step, inputs, labels
+                    del inputs, labels, buffer
+        finally:
+            for slot in slots:
+                try:
+                    slot.close()
+                except BufferError:
+                    # views still held by the caller
+                    pass
+                slot.unlink()
 
     def __call__(self):
         self.initialize(self.config)
         dataset = self.get_dataset(self.config)
-        self.run(self.config, dataset)
+        costs = self.get_costs(self.config, dataset) if self.config.balance_batches else None
+        self.run(self.config, dataset, costs)
 
-def main(argv):
+def parse_args(argv):
     import argparse
     argp = argparse.ArgumentParser(argv[0])
-    argp.add_argument('input_dir')
+    argp.add_argument('input_dir') # directory of the source images, or a packed archive (see archive.py)
     argp.add_argument('save_dir')
-    argp.add_argument('--params', required=True)
+    argp.add_argument('--params', nargs='+', required=True) # degradation profiles applied to each crop
     argp.add_argument('--random-seed', type=int)
     argp.add_argument('--batch-size', type=int, default=1)
-    argp.add_argument('--epochs', type=int, default=1)
+    argp.add_argument('--epochs', type=int, default=1) # 0: endless with --ring-size
     argp.add_argument('--shuffle', type=int, default=2) # 0: no shuffle, 1: shuffle once, 2: shuffle every epoch
     argp.add_argument('--log-freq', type=int, default=1000)
     argp.add_argument('--processes', type=int, default=8)
-    argp.add_argument('--dtype', default='float16')
+    argp.add_argument('--max-pending', type=int, default=0) # max in-flight tasks, 0: 4x processes
+    argp.add_argument('--crops-per-image', type=int, default=1) # number of crops from each decoded source
+    argp.add_argument('--variants', type=int, default=1) # degraded variants of each crop for each profile
+    argp.add_argument('--texture-tries', type=int, default=0) # candidate windows of texture-aware cropping, 0: uniform
+    argp.add_argument('--codec-threads', type=int, default=4) # workers of the thread stages in each process, 0: inline
+    argp.add_argument('--dtype', default='float16') # float16, float32, uint8, uint16
+    bool_argument(argp, 'dither', False) # dither when quantizing to uint8/uint16
+    argp.add_argument('--format', default='npz', choices=['npz', 'shard'])
+    argp.add_argument('--shard-size', type=int, default=256) # number of batches per shard file
+    argp.add_argument('--num-shards', type=int, default=1) # number of nodes generating the dataset
+    argp.add_argument('--shard-index', type=int, default=0) # index of this node
+    argp.add_argument('--ring-size', type=int, default=0) # keep a ring of the most recent batches in save_dir, 0: off
+    argp.add_argument('--source-cache') # directory for caching decoded sources
+    bool_argument(argp, 'cache-pre-down', False) # cache sources pre-downscaled by pre_scale
+    bool_argument(argp, 'label-refs', False) # store the labels as references into the source cache
+    bool_argument(argp, 'roi-decode', True) # only decode the region covering the crop
+    bool_argument(argp, 'draft-decode', False) # JPEG DCT-domain reduction for pre_scale, changes the labels
+    bool_argument(argp, 'noise-bank', False) # sample noise from pre-generated correlated noise tiles
+    bool_argument(argp, 'profile', False) # report per-stage timing
+    bool_argument(argp, 'save-plans', False) # save the degradation parameters next to each batch
+    argp.add_argument('--source-index') # file of the header-only metadata index
+    bool_argument(argp, 'balance-batches', False) # balance batches by expected cost, requires --source-index
+    argp.add_argument('--curation-index') # file of the perceptual hash and quality index
+    argp.add_argument('--min-sharpness', type=float) # exclude sources with lower Laplacian variance
+    argp.add_argument('--min-jpeg-quality', type=int) # exclude JPEG sources with lower estimated quality
+    argp.add_argument('--dedup-distance', type=int) # exclude near-duplicates within this pHash distance
     bool_argument(argp, 'test', False)
     bool_argument(argp, 'augment', True)
     bool_argument(argp, 'pre-down', False)
@@ -587,14 +1734,37 @@ def main(argv):
     # parse
     args = argp.parse_args(argv[1:])
     # force argument
+    assert 0 <= args.shard_index < args.num_shards
+    assert args.source_index is not None or not args.balance_batches
+    assert args.crops_per_image > 0 and args.batch_size % args.crops_per_image == 0
+    assert args.ring_size >= 0 and (args.ring_size == 0 or args.format == 'npz')
+    # the ring has a single producer, which numbers the batches and bounds the ring size
+    assert args.ring_size == 0 or args.num_shards == 1
+    assert args.epochs > 0 or args.ring_size > 0
+    assert args.variants > 0 and (len(args.params) * args.variants == 1 or not args.mixup)
+    assert args.curation_index is not None or (args.min_sharpness is None
+        and args.min_jpeg_quality is None and args.dedup_distance is None)
+    # the indexes stat and read the source files directly
+    args.archive = args.input_dir if is_archive(args.input_dir) else None
+    assert args.archive is None or (args.source_index is None and args.curation_index is None)
     if args.test:
         args.augment = False
         args.linear = False
         args.mixup = False
-    # load json
+    # the label references require the plain crops of the cached sources
+    assert not args.label_refs or (args.source_cache is not None and not args.linear and not args.mixup)
+    # load json, the first profile is the default params
     import json
-    with open(args.params) as fp:
-        args.params = json.load(fp)
+    args.profile_files = args.params
+    args.profiles = []
+    for params in args.profile_files:
+        with open(params) as fp:
+            args.profiles.append(json.load(fp))
+    args.params = args.profiles[0]
+    return args
+
+def main(argv):
+    args = parse_args(argv)
     # run data writer
     writer = DataWriter(args)
     writer()
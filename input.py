@@ -14,7 +14,8 @@ def input_arguments(argp):
     argp.add_argument('--noise-corr', type=float, default=0.75)
     argp.add_argument('--jpeg-coding', type=float, default=2.0)
 
-def inputs(config, files, is_training=False, is_testing=False):
+def inputs(config, files, is_training=False, is_testing=False, archive=None):
+    # files: file names, or member names of the archive (archive.Archive)
     # parameters
     channels = config.in_channels
     threads = config.threads
@@ -32,7 +33,7 @@ def inputs(config, files, is_training=False, is_testing=False):
     def parse1_func(filename):
         # read data
         dtype = tf.float32
-        image = tf.read_file(filename)
+        image = filename if archive is not None else tf.read_file(filename)
         image = tf.image.decode_image(image, channels=channels)
         shape = tf.shape(image)
         height = shape[-3]
@@ -465,7 +466,12 @@ def inputs(config, files, is_training=False, is_testing=False):
         return data, label
     
     # Dataset API
-    dataset = tf.data.Dataset.from_tensor_slices((files))
+    if archive is None:
+        dataset = tf.data.Dataset.from_tensor_slices((files))
+    else:
+        # the encoded data is read sequentially from the archive, then shuffled in the buffer
+        dataset = tf.data.Dataset.from_generator(lambda: archive.iter_data(files),
+            tf.string, tf.TensorShape([]))
     if is_training and buffer_size > 0: dataset = dataset.shuffle(buffer_size)
     dataset = dataset.map(parse1_func, num_parallel_calls=1 if is_testing else threads)
     dataset = dataset.map(lambda label: tuple(tf.py_func(parse2_pyfunc,
@@ -0,0 +1,135 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# ======
+# degradation stage graph
+# the stages are declared in order in the params JSON, e.g.
+#     "pipeline": [
+#         {"stage": "random_filter"},
+#         {"stage": "random_noise"},
+#         {"stage": "random_chroma"},
+#         {"stage": "random_quantize", "executor": "thread", "workers": 4, "batch": 2}
+#     ]
+# executor: "inline" (default) in the calling thread, or a "thread"/"process" pool of the worker process
+# batch: number of samples in each task submitted to the pool
+# adjacent stages of the same executor are merged into a segment, each sample flows through the segments,
+# so the inline segments of a sample run while the pooled segments of the other samples are in flight
+
+EXECUTORS = ['inline', 'thread', 'process']
+
+# per-process pools, created on first use
+_executors = {}
+
+def get_executor(kind, workers):
+    key = (kind, workers)
+    executor = _executors.get(key)
+    if executor is None:
+        if kind == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(workers)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context, util
+            # spawned, forking is unsafe as the calling process may run other pools' threads
+            executor = ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+            # shut down before the exiting process closes the queues and joins its children, e.g. in a worker of DataWriter
+            util.Finalize(executor, executor.shutdown, exitpriority=100)
+        _executors[key] = executor
+    return executor
+
+def run_segment(stages, items):
+    # apply the stages to each (context, data), return the list of (context, data, error)
+    results = []
+    for context, data in items:
+        try:
+            for stage in stages:
+                data = stage(context, data)
+            results.append((context, data, None))
+        except Exception as err:
+            results.append((context, None, err))
+    return results
+
+class Segment:
+    def __init__(self, stages, executor, workers, batch):
+        self.stages = stages
+        self.executor = executor
+        self.workers = workers
+        self.batch = batch
+
+class Job:
+    # a sample in the pipeline, result() drives the pipeline until the sample is done
+    def __init__(self, pipeline, context, data):
+        self.pipeline = pipeline
+        self.context = context
+        self.data = data
+        self.error = None
+        self.segment = 0
+        self.done = False
+
+    def result(self):
+        while not self.done:
+            self.pipeline.step()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+class Pipeline:
+    def __init__(self, spec, registry, workers=4):
+        # spec: list of {'stage', 'executor', 'workers', 'batch'}, registry: stage name => function(context, data)
+        self.segments = []
+        for entry in spec:
+            stage = registry[entry['stage']]
+            executor = entry.get('executor', 'inline')
+            if executor not in EXECUTORS:
+                raise ValueError('Unknown executor {} of stage {}'.format(executor, entry['stage']))
+            key = (executor, entry.get('workers', workers), entry.get('batch', 1))
+            last = self.segments[-1] if self.segments else None
+            if last is not None and (last.executor, last.workers, last.batch) == key:
+                last.stages.append(stage)
+            else:
+                self.segments.append(Segment([stage], *key))
+        self.buffers = [[] for _ in self.segments]
+        self.pending = {}
+
+    def start(self, context, data):
+        job = Job(self, context, data)
+        self.advance(job)
+        return job
+
+    def advance(self, job):
+        # run the inline segments, then queue the job for the next pooled segment
+        while job.segment < len(self.segments) and job.error is None:
+            index = job.segment
+            segment = self.segments[index]
+            if segment.executor != 'inline':
+                self.buffers[index].append(job)
+                if len(self.buffers[index]) >= segment.batch:
+                    self.submit(index)
+                return
+            job.context, job.data, job.error = run_segment(segment.stages, [(job.context, job.data)])[0]
+            job.segment += 1
+        job.done = True
+
+    def submit(self, index):
+        segment = self.segments[index]
+        jobs = self.buffers[index]
+        self.buffers[index] = []
+        items = [(job.context, job.data) for job in jobs]
+        future = get_executor(segment.executor, segment.workers).submit(run_segment, segment.stages, items)
+        self.pending[future] = jobs
+
+    def step(self):
+        # submit the partially filled batches, then wait for any pooled task and advance its jobs
+        for index, buffer in enumerate(self.buffers):
+            if buffer:
+                self.submit(index)
+        done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            jobs = self.pending.pop(future)
+            try:
+                results = future.result()
+            except Exception as err:
+                results = [(job.context, None, err) for job in jobs]
+            for job, result in zip(jobs, results):
+                job.context, job.data, job.error = result
+                job.segment += 1
+                self.advance(job)
@@ -1,17 +1,16 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import ndimage
-from scipy.interpolate import spline
 
 PATH = 'plot'
 if not os.path.exists(PATH): os.makedirs(PATH)
 
 def smooth(x, y, sigma=1.0):
+    from scipy import ndimage
     y_new = ndimage.gaussian_filter1d(y, sigma, mode='reflect')
     return x, y_new
 
 def plot1(postfix, labels=None, name=None):
+    import matplotlib.pyplot as plt
     MARKERS = 'x+^vDsoph*'
 
     if labels is None:
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+
+# ======
+# on-disk ring of packed batches, filled by DataWriter (--ring-size) while DataBase (--ring) trains on it
+# each batch is an .npz file named by its sequence number, published by an atomic rename,
+# the consumer takes the published batches in sequence order and retires (deletes) each one once loaded
+# backpressure: the producer keeps at most ring_size batches in the ring, including the ones in flight,
+# so the scratch disk is bounded while the training consumes fresh batches
+# a ring has a single producer (not partitioned with --num-shards), which owns the sequence numbers and META
+
+META = 'ring.json'
+VERSION = 1
+EXT = '.npz'
+
+class Ring:
+    def __init__(self, path, poll=0.1):
+        self.path = path
+        self.poll = poll
+        self.next = 0
+        self.taken = set()
+
+    def sequences(self):
+        # sequence numbers of the published batches, in order
+        return sorted(int(name[:-len(EXT)]) for name in os.listdir(self.path)
+            if name.endswith(EXT) and name[:-len(EXT)].isdigit())
+
+    def batch_path(self, seq):
+        return os.path.join(self.path, '{:012d}{}'.format(seq, EXT))
+
+    def count(self):
+        return len(self.sequences())
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.path, META), 'r', encoding='utf-8') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def write_meta(self, meta):
+        tmp_path = os.path.join(self.path, META + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump(meta, fd)
+        os.replace(tmp_path, os.path.join(self.path, META))
+
+    # producer
+
+    def start(self, **attrs):
+        # the sequence continues after the batches left in the ring by a previous run
+        os.makedirs(self.path, exist_ok=True)
+        self.next = max(self.sequences(), default=-1) + 1
+        self.write_meta(dict(attrs, version=VERSION, done=False))
+
+    def stop(self):
+        meta = self.read_meta() or {}
+        meta['done'] = True
+        self.write_meta(meta)
+
+    def next_path(self):
+        path = self.batch_path(self.next)
+        self.next += 1
+        return path
+
+    def wait(self, size):
+        # block until the consumer has retired enough batches to hold less than size
+        while self.count() >= size:
+            time.sleep(self.poll)
+
+    # consumer
+
+    def wait_meta(self):
+        meta = self.read_meta()
+        while meta is None:
+            time.sleep(self.poll)
+            meta = self.read_meta()
+        return meta
+
+    def take(self):
+        # return the path of the earliest published batch that is not taken yet,
+        # None when the producer has stopped and the ring is drained
+        while True:
+            # the done flag is read before listing, all the batches are published before it is set
+            meta = self.read_meta()
+            sequences = self.sequences()
+            # the retired batches are gone from the ring
+            self.taken.intersection_update(sequences)
+            for seq in sequences:
+                if seq not in self.taken:
+                    self.taken.add(seq)
+                    return self.batch_path(seq)
+            if meta is not None and meta['done']:
+                return None
+            time.sleep(self.poll)
@@ -0,0 +1,206 @@
+import numpy as np
+
+# ======
+# compiled degradation parameter sampler
+# the branch thresholds (cumulative percentages) in the params JSON are compiled once into tables,
+# then all the random decisions of a batch are drawn in one vectorized pass into a structured array,
+# which is executed by pre_process and optionally saved next to the batch for replay and analysis
+# the crop window is decided by the source size, it is recorded into the plan by DataWriter when cropping,
+# the noise is generated from the seeds in the plan, so a plan with its source fully describes the sample
+
+# branch names in the order of their thresholds, the last one takes the rest
+KERNELS = ['Point', 'Bilinear', 'Spline16', 'Spline36', 'Spline64', 'Lanczos',
+    'Hermite', 'B-Spline', 'RobidouxSoft', 'Robidoux', 'Mitchell', 'RobidouxSharp', 'Catmull-Rom',
+    'KeysCubic', 'SoftCubic', 'SharpCubic', 'ArtifactCubic', 'ArbitraryCubic']
+SCALES = ['NoScale', 'UpScale', 'DownScale']
+NOISES = ['NoNoise', 'RGB', 'YUV444', 'Y']
+CHROMAS = ['RGB', 'YUV420']
+QUANTS = ['NoQuant', 'Quant8', 'WebP', 'JPEG']
+
+# choices with uniform probabilities
+TRANSFERS = [None] * 3 + ['BT470_M', 'IEC_61966_2_1', 'IEC_61966_2_1']
+MATRICES = ['BT709'] * 3 + ['ST170_M', 'BT2020_NCL']
+CHROMA_FILTERS = (
+    [{'filter': 'Bicubic', 'filter_a': 0, 'filter_b': 0.5}] * 3 +
+    [{'filter': 'Bicubic', 'filter_a': 1/3, 'filter_b': 1/3}] * 2 +
+    [{'filter': 'Bicubic', 'filter_a': 0.75, 'filter_b': 0.25},
+    {'filter': 'Bicubic', 'filter_a': 1.0, 'filter_b': 0.0},
+    {'filter': 'Point'}, {'filter': 'Bilinear'},
+    {'filter': 'Lanczos', 'filter_a': 3}]
+)
+SUBSAMPLINGS = ['4:4:4'] * 3 + ['4:2:2', '4:2:0']
+QTABLES = [None, None, 'web_low', 'web_high']
+
+# (B, C) of the named Bicubic kernels
+CUBICS = {
+    'Hermite': (0, 0),
+    'B-Spline': (1, 0),
+    'RobidouxSoft': (0.67962275898295921, 0.1601886205085204), # (9-3*sqrt(2))/7, 0.5 - B * 0.5
+    'Robidoux': (0.37821575509399866, 0.31089212245300067), # 12/(19+9*sqrt(2), 113/(58+216*sqrt(2))
+    'Mitchell': (1 / 3, 1 / 3),
+    'RobidouxSharp': (0.2620145123990142, 0.3689927438004929), # 6/(13+7*sqrt(2)), 7/(2+12*sqrt(2)
+    'Catmull-Rom': (0, 0.5)
+}
+
+# parameters of a pre_process call, the 2 kernels are for the random scaling and the scaling to target size
+# crop: (offset_height, offset_width, cropped_height, cropped_width) in the decoded source with pre_scale
+PLAN_DTYPE = np.dtype([
+    ('pre_scale', 'f4'), ('crop', 'u4', (4,)),
+    ('transpose', 'u1'), ('flip', 'u1'), ('transfer', 'u1'), ('matrix', 'u1'),
+    ('scale', 'u1'), ('scale_rand', 'f8'),
+    ('kernel', 'u1', (2,)), ('kernel_a', 'f8', (2,)), ('kernel_b', 'f8', (2,)),
+    ('noise', 'u1'), ('corr_y', 'f8'), ('scale_y', 'f8'), ('corr_c', 'f8'), ('scale_c', 'f8'),
+    ('chroma', 'u1'), ('chroma_place', 'u1'), ('chroma_down', 'u1'), ('chroma_up', 'u1'),
+    ('quant', 'u1'), ('preset', 'u1'), ('quality', 'f8'), ('subsampling', 'u1'), ('qtables', 'u1'),
+    ('seed', 'u4'),
+    ('noise_seed', 'u4'), ('noise_flip', 'u1', (3,)), ('noise_offset', 'u4', (3, 2))
+])
+
+def compile_table(param, names):
+    # cumulative thresholds of the branches except the last one
+    return np.array([param[name] for name in names[:-1]], np.int64)
+
+def draw_branch(rng, table, size):
+    return np.searchsorted(table, rng.integers(0, 100, size), side='right').astype(np.uint8)
+
+def kernel_name(plan, index):
+    name = KERNELS[plan['kernel'][index]]
+    if name == 'Lanczos':
+        name += ' taps={}'.format(int(plan['kernel_a'][index]))
+    return name
+
+def kernel_filter(plan, index):
+    # return (filter, filter_a, filter_b)
+    name = KERNELS[plan['kernel'][index]]
+    if name == 'Lanczos':
+        return 'Lanczos', int(plan['kernel_a'][index]), None
+    elif name in KERNELS[:5]:
+        return name, None, None
+    return 'Bicubic', plan['kernel_a'][index], plan['kernel_b'][index]
+
+class Sampler:
+    def __init__(self, params, presets):
+        self.kernels = compile_table(params['random_resize'], KERNELS)
+        self.filter_param = params['random_filter']
+        self.scales = compile_table(self.filter_param, SCALES)
+        self.noise_param = params['random_noise']
+        self.noises = compile_table(self.noise_param, NOISES)
+        self.chromas = compile_table(params['random_chroma'], CHROMAS)
+        self.quant_param = params['random_quantize']
+        self.quants = compile_table(self.quant_param, QUANTS)
+        self.presets = presets
+
+    def sample_kernels(self, rng, size):
+        # return (kernel, B/taps, C) arrays
+        kernel = draw_branch(rng, self.kernels, size)
+        names = np.array(KERNELS)[kernel]
+        a = np.zeros(size)
+        b = np.zeros(size)
+        # Lanczos(taps=2~19)
+        mask = names == 'Lanczos'
+        a[mask] = rng.integers(2, 20, np.count_nonzero(mask))
+        # named Bicubic, randomly alternate the kernel with 80% probability
+        for name, (B, C) in CUBICS.items():
+            mask = names == name
+            a[mask] = B
+            b[mask] = C
+        mask = np.isin(names, list(CUBICS))
+        count = np.count_nonzero(mask)
+        alter = rng.integers(0, 10, count) > 1
+        a[mask] += np.where(alter, rng.normal(0, 0.05, count), 0)
+        b[mask] += np.where(alter, rng.normal(0, 0.05, count), 0)
+        # parameterized Bicubic, randomly alternate the kernel with 70%/90% probability
+        mask = names == 'KeysCubic'
+        count = np.count_nonzero(mask)
+        a[mask] = rng.uniform(0, 2 / 3, count) + rng.normal(0, 1 / 3, count)
+        b[mask] = 0.5 - a[mask] * 0.5
+        mask = names == 'SoftCubic'
+        count = np.count_nonzero(mask)
+        a[mask] = rng.uniform(0.5, 1, count) + rng.normal(0, 0.25, count)
+        b[mask] = 1 - a[mask]
+        mask = names == 'SharpCubic'
+        count = np.count_nonzero(mask)
+        a[mask] = rng.uniform(-0.75, -0.25, count) + rng.normal(0, 0.25, count)
+        b[mask] = a[mask] * -0.5
+        mask = np.isin(names, ['KeysCubic', 'SoftCubic', 'SharpCubic'])
+        count = np.count_nonzero(mask)
+        alter = rng.integers(0, 10, count) > np.where(names[mask] == 'KeysCubic', 2, 0)
+        a[mask] += np.where(alter, rng.normal(0, 1 / 6, count), 0)
+        b[mask] += np.where(alter, rng.normal(0, 1 / 6, count), 0)
+        # artifact Cubic
+        mask = names == 'ArtifactCubic'
+        count = np.count_nonzero(mask)
+        B = rng.uniform(-1.5, 1.5, count) # amount of haloing
+        aliasing = B >= 0
+        B = np.where(aliasing, 1 + B, 1 - B)
+        # when c is around b * 0.8, aliasing is minimum
+        mean = np.where(aliasing, 0.4, 0.8) * B
+        C = np.full(count, -1.0)
+        invalid = np.ones(count, bool)
+        while invalid.any():
+            C[invalid] = rng.normal(mean[invalid], B[invalid] * 0.2)
+            invalid = (C < 0) | (C > B * 1.2)
+        a[mask] = -B + rng.normal(0, 0.25, count)
+        b[mask] = C + rng.normal(0, 0.25, count)
+        # arbitrary Bicubic
+        mask = names == 'ArbitraryCubic'
+        count = np.count_nonzero(mask)
+        a[mask] = rng.uniform(-2, 2, count) + rng.normal(0, 0.5, count)
+        b[mask] = rng.uniform(-1, 2, count) + rng.normal(0, 0.5, count)
+        return kernel, a, b
+
+    def sample(self, rng, size):
+        plans = np.zeros(size, PLAN_DTYPE)
+        # augmentation, random transfer and matrix
+        plans['transpose'] = rng.integers(0, 2, size)
+        plans['flip'] = rng.integers(0, 4, size)
+        plans['transfer'] = rng.integers(0, len(TRANSFERS), size)
+        plans['matrix'] = rng.integers(0, len(MATRICES), size)
+        # random filter, the range of the scale is determined by the image size
+        plans['scale'] = draw_branch(rng, self.scales, size)
+        plans['scale_rand'] = rng.uniform(0, 1, size)
+        for index in range(2):
+            kernel, a, b = self.sample_kernels(rng, size)
+            plans['kernel'][:, index] = kernel
+            plans['kernel_a'][:, index] = a
+            plans['kernel_b'][:, index] = b
+        # random noise, no correlation if > sigma*3
+        noise_str = self.noise_param['noise_str']
+        noise_corr = self.noise_param['noise_corr']
+        for corr, scale in [('corr_y', 'scale_y'), ('corr_c', 'scale_c')]:
+            plans[corr] = np.abs(rng.normal(0.0, noise_corr, size))
+            plans[corr][plans[corr] > noise_corr * 3] = 0
+            plans[scale] = np.abs(rng.normal(0.0, noise_str, size)) * (1 + plans[corr])
+        plans['noise'] = draw_branch(rng, self.noises, size)
+        # random chroma sub-sampling
+        plans['chroma'] = draw_branch(rng, self.chromas, size)
+        plans['chroma_place'] = rng.integers(0, 2, size)
+        plans['chroma_down'] = rng.integers(0, len(CHROMA_FILTERS), size)
+        plans['chroma_up'] = rng.integers(0, len(CHROMA_FILTERS), size)
+        # random quantize
+        plans['quant'] = draw_branch(rng, self.quants, size)
+        plans['preset'] = rng.integers(0, self.presets, size)
+        plans['subsampling'] = rng.integers(0, len(SUBSAMPLINGS), size)
+        plans['qtables'] = rng.integers(0, len(QTABLES), size)
+        # WebP: random quality in [0, 100) with gamma correction
+        # gamma > 1.0: bias towards small values
+        # 0.0 < gamma < 1.0: bias towards big values
+        gamma = self.quant_param['webp_gamma']
+        webp_quality = rng.uniform(0, 100 ** (1 / gamma), size) ** gamma
+        # JPEG: normal distributed quality in [1, 100], uniform with qtables
+        jpeg_quality = rng.normal(self.quant_param['jpeg_mean'], self.quant_param['jpeg_std'], size)
+        invalid = (jpeg_quality < 1) | (jpeg_quality > 100)
+        while invalid.any():
+            jpeg_quality[invalid] = rng.normal(self.quant_param['jpeg_mean'], self.quant_param['jpeg_std'],
+                np.count_nonzero(invalid))
+            invalid = (jpeg_quality < 1) | (jpeg_quality > 100)
+        jpeg_quality = np.where(plans['qtables'] < 2, np.floor(jpeg_quality + 0.5), rng.integers(1, 101, size))
+        plans['quality'] = np.where(plans['quant'] == QUANTS.index('WebP'), webp_quality, jpeg_quality)
+        # seed of the dithering after quantization, which may run in another thread
+        plans['seed'] = rng.integers(0, 1 << 31, size)
+        # seed of the noise generator, and the tile flips and offsets of the noise bank for each plane,
+        # so that random_noise may also run in another thread or process
+        plans['noise_seed'] = rng.integers(0, 1 << 31, size)
+        plans['noise_flip'] = rng.integers(0, 8, (size, 3))
+        plans['noise_offset'] = rng.integers(0, 1 << 31, (size, 3, 2))
+        return plans
@@ -0,0 +1,143 @@
+import os
+import json
+import numpy as np
+
+# ======
+# sharded batch container
+# layout: [magic | header length | JSON header] [flags] [inputs] [labels]
+# each region starts at an ALIGNMENT boundary, so a batch is a page-aligned memmap slice
+# flags[i] is set to 1 after batch i has been written, which serves as the index
+
+MAGIC = b'SRNSHARD'
+VERSION = 1
+ALIGNMENT = 4096
+EXT = '.shard'
+
+def _align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _read_header(fd):
+    magic = fd.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('Not a shard file: {}'.format(fd.name))
+    length = int(np.frombuffer(fd.read(8), '<u8')[0])
+    return json.loads(fd.read(length).decode('utf-8'))
+
+def create_shard(path, batches, batch_size, input_shape, label_shape, dtype, label_dtype=None, **attrs):
+    # label_dtype: defaults to dtype, a structured dtype is stored by its fields
+    dtype = np.dtype(dtype)
+    label_dtype = dtype if label_dtype is None else np.dtype(label_dtype)
+    samples = batches * batch_size
+    header = {
+        'version': VERSION,
+        'batches': batches,
+        'batch_size': batch_size,
+        'dtype': dtype.str,
+        'input_shape': [samples] + list(input_shape),
+        'label_shape': [samples] + list(label_shape)
+    }
+    if label_dtype != dtype:
+        header['label_dtype'] = label_dtype.descr if label_dtype.names else label_dtype.str
+    header.update(attrs)
+    # region offsets, the header size is reserved with enough margin for the offsets
+    reserved = len(json.dumps(header).encode('utf-8')) + 256
+    header['flags_offset'] = _align(len(MAGIC) + 8 + reserved)
+    header['inputs_offset'] = _align(header['flags_offset'] + batches)
+    input_bytes = int(np.prod(header['input_shape'])) * dtype.itemsize
+    header['labels_offset'] = _align(header['inputs_offset'] + input_bytes)
+    label_bytes = int(np.prod(header['label_shape'])) * label_dtype.itemsize
+    size = header['labels_offset'] + label_bytes
+    # write header and allocate the whole (sparse) file
+    encoded = json.dumps(header).encode('utf-8')
+    assert len(MAGIC) + 8 + len(encoded) <= header['flags_offset']
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(np.uint64(len(encoded)).astype('<u8').tobytes())
+        fd.write(encoded)
+        fd.truncate(size)
+    os.replace(tmp_path, path)
+    return header
+
+class Shard:
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(path, 'rb') as fd:
+            self.header = _read_header(fd)
+        self.batches = self.header['batches']
+        self.batch_size = self.header['batch_size']
+        self.dtype = np.dtype(self.header['dtype'])
+        label_dtype = self.header.get('label_dtype', self.header['dtype'])
+        self.label_dtype = np.dtype([tuple(field) for field in label_dtype]
+            if isinstance(label_dtype, list) else label_dtype)
+        self._inputs = None
+        self._labels = None
+
+    @property
+    def inputs(self):
+        if self._inputs is None:
+            self._inputs = np.memmap(self.path, self.dtype, self.mode,
+                self.header['inputs_offset'], tuple(self.header['input_shape']))
+        return self._inputs
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = np.memmap(self.path, self.label_dtype, self.mode,
+                self.header['labels_offset'], tuple(self.header['label_shape']))
+        return self._labels
+
+    def filled(self):
+        with open(self.path, 'rb') as fd:
+            fd.seek(self.header['flags_offset'])
+            flags = np.frombuffer(fd.read(self.batches), np.uint8)
+        return np.nonzero(flags)[0].tolist()
+
+    def read_batch(self, index):
+        begin = index * self.batch_size
+        end = begin + self.batch_size
+        return self.inputs[begin : end], self.labels[begin : end]
+
+    def write_batch(self, index, inputs, labels):
+        begin = index * self.batch_size
+        end = begin + self.batch_size
+        self.inputs[begin : end] = inputs
+        self.labels[begin : end] = labels
+        self.inputs.flush()
+        self.labels.flush()
+        # mark as filled only after the data is written (flushed to disk by the memmaps)
+        with open(self.path, 'r+b') as fd:
+            fd.seek(self.header['flags_offset'] + index)
+            fd.write(b'\x01')
+            fd.flush()
+            os.fsync(fd.fileno())
+
+# cache opened shards within each process
+_shards = {}
+
+def open_shard(path, mode='r'):
+    key = (path, mode)
+    shard = _shards.get(key)
+    if shard is None:
+        shard = Shard(path, mode)
+        _shards[key] = shard
+    return shard
+
+def write_batch(path, index, inputs, labels):
+    # writers don't cache the memmap, shards are only written once per batch
+    shard = Shard(path, 'r+')
+    shard.write_batch(index, inputs, labels)
+
+def read_batch(path, index):
+    return open_shard(path).read_batch(index)
+
+def list_batches(files):
+    # expand shard files into (path, index) entries of the filled batches
+    entries = []
+    for file in files:
+        if os.path.splitext(file)[1] == EXT:
+            entries += [(file, index) for index in Shard(file).filled()]
+        else:
+            entries.append(file)
+    return entries
@@ -0,0 +1,77 @@
+import os
+import json
+from utils import eprint
+
+# ======
+# header-only metadata index of the source images
+# each entry holds (width, height, mode, format) from the image header and (size, mtime) for refreshing
+# unreadable files are kept with an 'error' entry, so they are not re-read until modified
+
+def read_header(file):
+    from PIL import Image
+    entry = {'size': -1, 'mtime': -1}
+    try:
+        stat = os.stat(file)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        with Image.open(file) as im:
+            entry['width'], entry['height'] = im.size
+            entry['mode'] = im.mode
+            entry['format'] = im.format
+    except Exception as err:
+        entry['error'] = str(err)
+    return entry
+
+def read_headers(files):
+    return [read_header(file) for file in files]
+
+class SourceIndex:
+    # reads the entries of a list of files, overridden by derived indexes
+    read_entries = staticmethod(read_headers)
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fd:
+                self.entries = json.load(fd)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump(self.entries, fd)
+        os.replace(tmp_path, self.path)
+
+    def update(self, files, processes=8, chunk_size=256):
+        # only read the entries of new or modified files
+        stale = []
+        for file in files:
+            entry = self.entries.get(file)
+            if entry is not None:
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    stale.append(file)
+                    continue
+                if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                    continue
+            stale.append(file)
+        # drop removed files
+        listed = set(files)
+        self.entries = {file: entry for file, entry in self.entries.items() if file in listed}
+        if not stale:
+            return 0
+        eprint('Indexing {} files into {}'.format(len(stale), self.path))
+        chunks = [stale[i : i + chunk_size] for i in range(0, len(stale), chunk_size)]
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as executor:
+            for chunk, entries in zip(chunks, executor.map(self.read_entries, chunks)):
+                self.entries.update(zip(chunk, entries))
+        self.save()
+        return len(stale)
+
+    def readable(self, file):
+        entry = self.entries.get(file)
+        return entry is not None and 'error' not in entry
+
+    def get(self, file):
+        return self.entries.get(file)
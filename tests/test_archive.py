@@ -0,0 +1,36 @@
+import os
+import numpy as np
+from archive import Archive
+
+def test_iter_data(tmp_path):
+    # members spread over several blobs, some of them replaced, read sequentially in small chunks
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    rng = np.random.default_rng(0)
+    files = []
+    for index in range(20):
+        path = src_dir / '{:02d}.png'.format(index)
+        path.write_bytes(rng.bytes(int(rng.integers(1, 300))))
+        files.append(str(path))
+    archive = Archive(str(tmp_path / 'archive'))
+    archive.append(str(src_dir), files, blob_size=1000)
+    for path in files[3:6]:
+        with open(path, 'ab') as fd:
+            fd.write(b'modified')
+        os.utime(path, ns=(0, 0))
+    archive.append(str(src_dir), files, blob_size=1000)
+    archive = Archive(str(tmp_path / 'archive'))
+    assert len({member['blob'] for member in archive.members}) > 1
+    def read(path):
+        with open(path, 'rb') as fd:
+            return fd.read()
+    def archive_order(names):
+        return sorted(names, key=lambda name: (archive.member(name)['blob'], archive.member(name)['offset']))
+    # all the members in the archive order, the replaced ones are read from their new data
+    expected = archive_order(archive.names)
+    assert expected != archive.names
+    assert list(archive.iter_data(chunk_size=500)) == [read(str(src_dir / name)) for name in expected]
+    # a subset of the members, yielded in the archive order regardless of the order of keys
+    names = ['{:02d}.png'.format(index) for index in [15, 2, 4, 9]]
+    expected = archive_order(names)
+    assert list(archive.iter_data(names, chunk_size=500)) == [read(str(src_dir / name)) for name in expected]
@@ -0,0 +1,49 @@
+import random
+from dataset import DataWriter
+
+def batch_costs(dataset, costs, batch_size):
+    num_batches = len(dataset) // batch_size
+    return [sum(costs[ifile][1] for ifile in dataset[i * batch_size:(i + 1) * batch_size])
+        for i in range(num_batches)]
+
+def test_balance_batches():
+    rng = random.Random(0)
+    costs = {'{}.png'.format(i): (1, rng.choice([1, 4, 9]) * rng.uniform(0.5, 1.5)) for i in range(1003)}
+    batch_size = 10
+    random.seed(0)
+    results = []
+    for epoch in range(3):
+        dataset = list(costs)
+        DataWriter.balance_batches(dataset, costs, batch_size)
+        assert sorted(dataset) == sorted(costs)
+        # similar total cost for all the batches
+        totals = batch_costs(dataset, costs, batch_size)
+        assert max(totals) - min(totals) < 0.1 * sum(totals) / len(totals)
+        results.append(dataset)
+    # different batches and leftovers across epochs
+    batches = [{frozenset(dataset[i:i + batch_size]) for i in range(0, 1000, batch_size)} for dataset in results]
+    assert len(batches[0] & batches[1]) < 10 and len(batches[1] & batches[2]) < 10
+    assert results[0][1000:] != results[1][1000:] != results[2][1000:]
+
+def test_balance_pre_scale_classes():
+    rng = random.Random(0)
+    costs = {}
+    for pre_scale, count in [(1, 333), (2, 335), (3, 335)]:
+        for i in range(count):
+            costs['{}_{}.png'.format(pre_scale, i)] = (pre_scale, pre_scale ** 2 * rng.uniform(0.5, 1.5))
+    batch_size = 10
+    random.seed(0)
+    dataset = list(costs)
+    DataWriter.balance_batches(dataset, costs, batch_size)
+    assert sorted(dataset) == sorted(costs)
+    # 33 batches of each class, then the batch of the mixed leftovers
+    batches = [dataset[i:i + batch_size] for i in range(0, len(dataset) // batch_size * batch_size, batch_size)]
+    classes = [{costs[ifile][0] for ifile in batch} for batch in batches]
+    assert all(len(_classes) == 1 for _classes in classes[:99])
+    assert sorted(min(_classes) for _classes in classes[:99]) == [1] * 33 + [2] * 33 + [3] * 33
+    # the batches of each class are balanced and mixed across the classes
+    assert len({tuple(_classes) for _classes in classes[:10]}) > 1
+    for pre_scale in [1, 2, 3]:
+        totals = [sum(costs[ifile][1] for ifile in batch) for batch, _classes in zip(batches, classes[:99])
+            if _classes == {pre_scale}]
+        assert max(totals) - min(totals) < 0.1 * sum(totals) / len(totals)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import curation
+
+def make_entries(count, max_distance, seed=0):
+    # random hashes, with near-duplicates (within and beyond max_distance) of the first tenth
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 1 << 64, count, dtype=np.uint64, endpoint=False)
+    for index in range(count // 10):
+        bits = rng.choice(64, rng.integers(0, max_distance + 3), replace=False)
+        values[count - 1 - index] = values[index] ^ np.uint64(sum(1 << int(bit) for bit in bits))
+    return {'{}.png'.format(index): {'phash': '{:016x}'.format(int(value)), 'width': 64, 'height': 64,
+        'jpeg_quality': None, 'sharpness': float(index)} for index, value in enumerate(values)}
+
+def brute_force(entries, max_distance):
+    from scipy.sparse.csgraph import connected_components
+    files = list(entries)
+    values = np.array([int(entries[file]['phash'], 16) for file in files], np.uint64)
+    close = curation.popcount(values[:, None] ^ values[None, :]) <= max_distance
+    _, labels = connected_components(close, directed=False)
+    # the sharpest one of each group is kept
+    keep = {}
+    for index, label in enumerate(labels):
+        if label not in keep or entries[files[index]]['sharpness'] > entries[files[keep[label]]]['sharpness']:
+            keep[label] = index
+    kept = set(keep.values())
+    return {file for index, file in enumerate(files) if index not in kept}
+
+@pytest.mark.parametrize('max_distance', [0, 4, 10])
+def test_find_duplicates(max_distance):
+    entries = make_entries(5000, max_distance)
+    duplicates = curation.find_duplicates(entries, max_distance)
+    assert duplicates == brute_force(entries, max_distance)
+    assert len(duplicates) >= 5000 // 50
+
+def test_popcount_fallback(monkeypatch):
+    values = np.random.default_rng(0).integers(0, 1 << 64, 1000, dtype=np.uint64, endpoint=False)
+    expected = [bin(int(value)).count('1') for value in values]
+    assert curation.popcount(values).tolist() == expected
+    monkeypatch.delattr(np, 'bitwise_count', raising=False)
+    assert curation.popcount(values).tolist() == expected
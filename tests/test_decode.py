@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+import pytest
+import dataset
+
+def make_config(**kwargs):
+    return SimpleNamespace(**dict(dict(archive=None, pre_down=False, draft_decode=False, texture_tries=0,
+        patch_width=32, patch_height=24), **kwargs))
+
+def full_decode(config, ifile, pre_scale=1):
+    # decode the whole image, then crop the same window
+    img = np.array(Image.open(ifile))
+    height, width = img.shape[:2]
+    offset_height, offset_width, cropped_height, cropped_width = dataset.crop_window(config, width, height, pre_scale)
+    img = img[offset_height : offset_height + cropped_height, offset_width : offset_width + cropped_width]
+    return dataset.pad_patch(dataset.regularize(img), cropped_height, cropped_width)
+
+@pytest.mark.parametrize('supported', [True, False])
+@pytest.mark.parametrize('mode', ['L', 'LA', 'RGB', 'RGBA', 'I;16'])
+def test_truncated_decode(tmp_path, monkeypatch, mode, supported):
+    if not supported:
+        monkeypatch.setattr(dataset, '_png_truncate', False)
+    truncated = []
+    truncate_png = dataset.truncate_png
+    monkeypatch.setattr(dataset, 'truncate_png', lambda im, bottom: truncated.append(truncate_png(im, bottom)))
+    rng = np.random.default_rng(0)
+    channels = {'L': (), 'LA': (2,), 'RGB': (3,), 'RGBA': (4,), 'I;16': ()}[mode]
+    dtype = np.uint16 if mode == 'I;16' else np.uint8
+    img = rng.integers(0, np.iinfo(dtype).max, (90, 70) + channels, dtype=dtype, endpoint=True)
+    ifile = str(tmp_path / 'image.png')
+    im = Image.fromarray(img)
+    assert im.mode == mode
+    im.save(ifile)
+    config = make_config()
+    for seed in range(10):
+        np.random.seed(seed)
+        patch, pre_scale, window = dataset.decode_patch(config, ifile)
+        np.random.seed(seed)
+        expected = full_decode(config, ifile)
+        assert pre_scale == 1
+        np.testing.assert_array_equal(patch, expected)
+    # some windows end above the bottom, where the decoding is truncated if supported
+    assert truncated and all(applied == supported for applied in truncated)
+
+@pytest.mark.parametrize('draft_decode', [False, True])
+def test_draft_decode(tmp_path, draft_decode):
+    # the JPEG DCT-domain reduction is only applied with draft_decode, otherwise the full resolution is decoded
+    # and the pre downscaling is left to the linear-light resizing
+    ifile = str(tmp_path / 'image.jpg')
+    gradient = np.linspace(0, 255, 1600, dtype=np.float32)
+    img = np.stack([np.add.outer(gradient[:800] / 2, gradient / 2)] * 3, axis=-1).astype(np.uint8)
+    Image.fromarray(img).save(ifile, quality=95)
+    config = make_config(pre_down=True, draft_decode=draft_decode)
+    np.random.seed(0)
+    patch, pre_scale, window = dataset.decode_patch(config, ifile)
+    if draft_decode:
+        assert pre_scale == 1 and window[2:] == (24, 32)
+    else:
+        assert pre_scale == 2 and window[2:] == (48, 64)
+        np.random.seed(0)
+        np.testing.assert_array_equal(patch, full_decode(config, ifile, 2))
+
+def test_texture_window_alpha():
+    # the alpha doesn't take part in the detail
+    config = SimpleNamespace(texture_tries=8, patch_width=16, patch_height=16)
+    rng = np.random.default_rng(0)
+    gray = np.zeros((64, 64), np.uint8)
+    gray[40:, 40:] = rng.integers(0, 256, (24, 24))
+    alpha = rng.integers(0, 256, (64, 64), dtype=np.uint8)
+    def windows(img):
+        result = []
+        for seed in range(20):
+            np.random.seed(seed)
+            result.append(dataset.texture_window(config, img, 1, regularized=False))
+        return result
+    expected = windows(gray)
+    assert windows(np.stack([gray, alpha], axis=-1)) == expected
+    assert windows(np.stack([gray] * 3 + [alpha], axis=-1)) == expected
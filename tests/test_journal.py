@@ -0,0 +1,22 @@
+import os
+import dataset
+
+def test_journal_per_shard(tmp_path):
+    journal = dataset.Journal(str(tmp_path), 1)
+    journal.record(0, 3)
+    journal.record(1, 5)
+    journal.close()
+    assert os.path.exists(str(tmp_path / 'journal.1.log'))
+    journal = dataset.Journal(str(tmp_path), 1)
+    assert (0, 3) in journal and (1, 5) in journal
+    # the other shards have their own journals
+    assert (0, 3) not in dataset.Journal(str(tmp_path), 0)
+
+def test_journal_torn(tmp_path):
+    with open(str(tmp_path / 'journal.0.log'), 'w', encoding='utf-8') as fd:
+        fd.write('0 1\n0 2\n0 ')
+    journal = dataset.Journal(str(tmp_path))
+    assert (0, 1) in journal and (0, 2) in journal and journal.torn
+    journal.record(0, 3)
+    journal.close()
+    assert (0, 3) in dataset.Journal(str(tmp_path))
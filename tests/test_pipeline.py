@@ -0,0 +1,108 @@
+import copy
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import dataset
+from sampler import Sampler
+
+# degradations without the codec and resizer bindings:
+# no scaling, RGB/Y noise, no chroma sub-sampling, 8-bit quantization
+PARAMS = {
+    'random_resize': {'Point': 3, 'Bilinear': 9, 'Spline16': 10, 'Spline36': 11, 'Spline64': 12, 'Lanczos': 28,
+        'Hermite': 30, 'B-Spline': 32, 'RobidouxSoft': 34, 'Robidoux': 36, 'Mitchell': 38, 'RobidouxSharp': 40,
+        'Catmull-Rom': 50, 'KeysCubic': 70, 'SoftCubic': 75, 'SharpCubic': 80, 'ArtifactCubic': 86,
+        'ArbitraryCubic': 100},
+    'random_filter': {'max_scale': 1.0, 'min_scale': -2.0, 'NoScale': 100, 'UpScale': 100, 'DownScale': 100},
+    'random_noise': {'noise_str': 0.05, 'noise_corr': 0.5, 'NoNoise': 0, 'RGB': 50, 'YUV444': 50, 'Y': 100},
+    'random_chroma': {'RGB': 100, 'YUV420': 100},
+    'random_quantize': {'NoQuant': 50, 'Quant8': 100, 'WebP': 100, 'JPEG': 100,
+        'webp_gamma': 0.5, 'jpeg_mean': 90, 'jpeg_std': 30}
+}
+
+PIPELINES = {
+    'inline': [],
+    'thread': [{'stage': 'random_filter'}, {'stage': 'random_noise', 'executor': 'thread', 'workers': 2},
+        {'stage': 'random_chroma'}, {'stage': 'random_quantize', 'executor': 'thread', 'workers': 2}],
+    'process': [{'stage': 'random_filter', 'executor': 'process', 'workers': 2}, {'stage': 'random_noise'},
+        {'stage': 'random_chroma'}, {'stage': 'random_quantize'}],
+    'process_all': [{'stage': 'random_filter', 'executor': 'process', 'workers': 2, 'batch': 2},
+        {'stage': 'random_noise', 'executor': 'process', 'workers': 2, 'batch': 2},
+        {'stage': 'random_chroma', 'executor': 'process', 'workers': 2, 'batch': 2},
+        {'stage': 'random_quantize', 'executor': 'process', 'workers': 2, 'batch': 2}]
+}
+
+def make_config(noise_bank):
+    return SimpleNamespace(patch_width=32, patch_height=32, scale=1, augment=True, linear=False,
+        transfer='IEC_61966_2_1', dither=True, noise_bank=noise_bank, random_seed=None, codec_threads=2)
+
+def run(config, name, count=8):
+    params = copy.deepcopy(PARAMS)
+    pipeline = dataset.get_pipeline(config, params, inline=True) if name == 'inline' else None
+    if pipeline is None:
+        params['pipeline'] = PIPELINES[name]
+        pipeline = dataset.get_pipeline(config, params)
+    plans = Sampler(params, 1).sample(np.random.default_rng(0), count)
+    plans['transfer'] = 0 # no transfer conversion
+    images = np.random.default_rng(1).integers(0, 256, (count, 3, 32, 32), dtype=np.uint8)
+    inputs = []
+    for index in range(count):
+        # the global random state is reset for each sample, e.g. by the crops of the next source
+        dataset.seed_sample(index)
+        _input, _ = dataset.pre_process(config, images[index], np.uint8, 1, cropped=True,
+            pipeline=pipeline, plan=plans[index], params=params)
+        inputs.append(_input)
+    return np.stack([_input if isinstance(_input, np.ndarray) else _input.result() for _input in inputs])
+
+@pytest.mark.parametrize('noise_bank', [False, True])
+def test_executors_identical(noise_bank):
+    config = make_config(noise_bank)
+    expected = run(config, 'inline')
+    for name in ['thread', 'process', 'process_all']:
+        np.testing.assert_array_equal(run(config, name), expected, err_msg=name)
+
+@pytest.mark.parametrize('name', ['inline', 'thread'])
+def test_timer_identical(name):
+    # the timing doesn't take part in the random draws
+    config = make_config(False)
+    expected = run(config, name)
+    dataset.TIMER.enabled = True
+    try:
+        result = run(config, name)
+        durations = dataset.TIMER.snapshot()
+    finally:
+        dataset.TIMER.enabled = False
+    np.testing.assert_array_equal(result, expected)
+    assert any(name.startswith('random_noise/') for name in durations)
+
+def test_context_without_config():
+    # the context is pickled with every sample for the process executor
+    import pickle
+    config = make_config(False)
+    config.profile_files = ['config/dataset.blur.json']
+    plan = Sampler(PARAMS, 1).sample(np.random.default_rng(0), 1)[0]
+    context = dataset.StageContext(config, plan, PARAMS, np.uint8)
+    assert not any(value is config for value in vars(context).values())
+    assert b'profile_files' not in pickle.dumps(context)
+
+def test_timer_report_random_state():
+    # the reservoir sampling of the report doesn't consume the global random state
+    import random
+    report = dataset.TimerReport(capacity=10)
+    random.seed(0)
+    expected = random.random()
+    random.seed(0)
+    report.merge({'stage': [0.001] * 100})
+    assert random.random() == expected
+    assert report.summary()['stage']['count'] == 100
+
+def test_quantize_keeps_type():
+    # without the output dtype, the quantized data stays in uint8 for the transfer LUT
+    plans = Sampler(PARAMS, 1).sample(np.random.default_rng(0), 64)
+    src = np.random.default_rng(1).random((3, 16, 16), dtype=np.float32)
+    for quant in [dataset.QUANTS.index('NoQuant'), dataset.QUANTS.index('Quant8')]:
+        plan = plans[plans['quant'] == quant][0]
+        result = dataset.random_quantize(plan, src, None, channel_first=True)
+        expected = np.float32 if dataset.QUANTS[quant] == 'NoQuant' else np.uint8
+        assert result.dtype == expected
+        np.testing.assert_array_equal(dataset.convert_dtype(result, np.float32),
+            dataset.random_quantize(plan, src, np.float32, channel_first=True))
@@ -0,0 +1,60 @@
+import os
+import json
+import random
+import numpy as np
+import pytest
+from PIL import Image
+import dataset
+from sampler import Sampler
+from test_pipeline import PARAMS
+
+class PlainSampler(Sampler):
+    # no transfer conversion, which needs the resizer bindings
+    def sample(self, rng, size):
+        plans = super().sample(rng, size)
+        plans['transfer'] = 0
+        return plans
+
+def make_config(tmp_path, *args):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for index in range(6):
+        img = rng.integers(0, 256, (48, 40, 3), dtype=np.uint8)
+        Image.fromarray(img).save(str(src_dir / '{}.png'.format(index)))
+    params = tmp_path / 'params.json'
+    params.write_text(json.dumps(PARAMS))
+    return dataset.parse_args(['dataset.py', str(src_dir), str(tmp_path / 'out'), '--params', str(params),
+        '--random-seed', '0', '--batch-size', '2', '--epochs', '2', '--processes', '2', '--patch-width', '32',
+        '--patch-height', '32', '--dtype', 'uint8', '--codec-threads', '0', '--log-freq', '100'] + list(args))
+
+def test_iterate_roundtrip(tmp_path, monkeypatch):
+    # the batches yielded from the shared memory slots are the ones generated by the workers
+    # the workers are forked, so they inherit the patched sampler
+    sampler = PlainSampler(PARAMS, 1)
+    monkeypatch.setattr(dataset, 'get_sampler', lambda params: sampler)
+    config = make_config(tmp_path, '--max-pending', '2')
+    files = dataset.DataWriter.get_dataset(config)
+    shm_dir = '/dev/shm'
+    slots_before = set(os.listdir(shm_dir)) if os.path.isdir(shm_dir) else set()
+    random.seed(0)
+    batches = [(epoch, step, inputs.copy(), labels.copy())
+        for epoch, step, inputs, labels in dataset.DataWriter.iterate(config, files)]
+    # the same tasks generated in this process
+    random.seed(0)
+    _dataset, _dataset2, epoch_steps, progress, _ = dataset.DataWriter.prepare(config, files)
+    tasks = list(dataset.DataWriter.gen_tasks(config, _dataset, _dataset2, epoch_steps, progress, save=False))
+    assert len(batches) == 2 * 3
+    assert [(epoch, step) for epoch, step, _, _ in batches] == [(epoch, step) for epoch, step, *_ in tasks]
+    for (_, _, inputs, labels), (_, _, _, ifiles, _, seed) in zip(batches, tasks):
+        expected_inputs, expected_labels, _ = dataset.DataWriter.process_batch(config, ifiles, seed)
+        np.testing.assert_array_equal(inputs, expected_inputs)
+        np.testing.assert_array_equal(labels, expected_labels)
+    # the slots are released
+    if os.path.isdir(shm_dir):
+        assert set(os.listdir(shm_dir)) <= slots_before
+
+def test_ring_single_producer(tmp_path):
+    # writers partitioned across nodes would publish the same sequence numbers into a shared ring
+    with pytest.raises(AssertionError):
+        make_config(tmp_path, '--ring-size', '4', '--num-shards', '2', '--shard-index', '1')
@@ -1,6 +1,19 @@
-import tensorflow.compat.v1 as tf
 import numpy as np
 
+# NOTE: TensorFlow is only imported by the functions using it,
+# so that the data pipelines (dataset.py, data.py) don't load it in each worker
+
+# module imported on the first attribute access
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        import importlib
+        value = getattr(importlib.import_module(self._name), attr)
+        self.__dict__[attr] = value
+        return value
+
 def bool_argument(argp, name, default):
     dest = name.replace('-', '_')
     argp.add_argument('--' + name, dest=dest, action='store_true')
@@ -28,6 +41,15 @@ def makedirs(dirname):
             if exc.errno != errno.EEXIST:
                 raise
 
+# make the created and renamed entries in the directory durable
+def fsync_dir(dirname):
+    import os
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def makedirs_f(file):
     makedirs(get_dirname(file))
 
@@ -86,13 +108,18 @@ def listdir_files(path, recursive=True, filter_ext=None, encoding=None):
 
 # reset random seeds
 def reset_random(seed=0):
+    import sys
     import random
-    tf.set_random_seed(seed)
+    # the graph-level seed is only set when TensorFlow is in use
+    if 'tensorflow' in sys.modules:
+        import tensorflow.compat.v1 as tf
+        tf.set_random_seed(seed)
     random.seed(seed)
     np.random.seed(seed)
 
 # setup tensorflow and return session
 def create_session(graph=None, debug=False, memory_fraction=1.0):
+    import tensorflow.compat.v1 as tf
     # create session
     gpu_options = tf.GPUOptions(allow_growth=True,
         per_process_gpu_memory_fraction=memory_fraction)
@@ -106,7 +133,9 @@ def create_session(graph=None, debug=False, memory_fraction=1.0):
     return sess
 
 # encode a batch of images to a list of pngs
-def BatchPNG(images, batch_size, dtype=tf.uint8):
+def BatchPNG(images, batch_size, dtype=None):
+    import tensorflow.compat.v1 as tf
+    if dtype is None: dtype = tf.uint8
     pngs = []
     for i in range(batch_size):
         img = images[i]